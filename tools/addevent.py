@@ -0,0 +1,6 @@
+import sys
+import gitmer
+
+# addevent.py type [project [repository/package [arch]]]
+event = (sys.argv[1:] + ["", "", ""])[:4]
+gitmer.append_events([event])
@@ -0,0 +1,496 @@
+# Event loop server for fakeobs. A single thread multiplexes every
+# connection with poll(). Complete requests go to a fixed pool of worker
+# threads running the normal request handler. /public/lastevents requests
+# with nothing to report yet are parked in the loop until new events come
+# in, so an idle watcher costs a socket instead of a thread. Requests to an
+# endpoint at its limit wait in the loop for their turn the same way, so
+# they don't take workers away from everything else. Large response bodies
+# are written by the loop as the client takes them, so slow downloads
+# don't hold workers either.
+
+import asyncore
+import collections
+import errno
+import fcntl
+import heapq
+import os
+import re
+import socket
+import sys
+import threading
+import time
+import traceback
+import Queue
+import gitmer
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+# Largest request header accepted before the connection is dropped
+MAXHEADERSIZE = 65536
+
+HEADEREND = re.compile(r"\r?\n\r?\n")
+
+# Response bodies larger than this are handed back to the loop to send
+HANDOVER_MINSIZE = 64 * 1024
+
+# Bytes of a handed over body read at a time
+WRITECHUNK = 256 * 1024
+
+# Runs one request that has already been read off the connection. The
+# socket is in blocking mode and owned by the worker thread until the
+# request has been answered, or its headers have been and the body is
+# left in handedover for the loop to send.
+def make_handler(handlerclass):
+    class AsyncRequestHandler(handlerclass):
+        # Requests are only handed over once there is something to say,
+        # or the wait is over
+        lastevents_maxwait = 0
+
+        def __init__(self, request, client_address, server, data, requests):
+            self.data = data
+            self.previous = requests
+            handlerclass.__init__(self, request, client_address, server)
+
+        def setup(self):
+            self.connection = self.request
+            self.connection.settimeout(self.timeout)
+            self.rfile = StringIO(self.data)
+            self.wfile = self.connection.makefile('wb', self.wbufsize)
+            self.requests = self.previous
+            self.bodyread = False
+            self.headerlines = None
+            self.handedover = None
+
+        def handle(self):
+            self.close_connection = 1
+            self.handle_one_request()
+
+        # The loop took the request's turn before handing it over, see
+        # AsyncHTTPServer.check()
+        def take_slot(self, endpoint):
+            return True
+
+        def hand_over_body(self, f):
+            if self.contentlength is None or self.contentlength <= HANDOVER_MINSIZE:
+                return False
+            self.wfile.flush()
+            self.handedover = f
+            return True
+
+    return AsyncRequestHandler
+
+# Wakes the loop up from other threads through a pipe
+class Waker(asyncore.file_dispatcher):
+    def __init__(self, map):
+        readfd, self.writefd = os.pipe()
+        fcntl.fcntl(self.writefd, fcntl.F_SETFL, fcntl.fcntl(self.writefd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        asyncore.file_dispatcher.__init__(self, readfd, map=map)
+        os.close(readfd)
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except OSError:
+            pass
+
+    def wake(self, *args):
+        try:
+            os.write(self.writefd, "x")
+        except OSError, e:
+            # A full pipe will wake the loop up just as well
+            if e.errno != errno.EAGAIN:
+                raise
+
+class Listener(asyncore.dispatcher):
+    def __init__(self, server, address):
+        asyncore.dispatcher.__init__(self, map=server.map)
+        self.server = server
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(128)
+
+    def writable(self):
+        return False
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        if not self.server.add_connection():
+            print "503: too many connections, turning away %s" % (pair[1],)
+            try:
+                pair[0].sendall(self.server.overloaded)
+            except socket.error:
+                pass
+            pair[0].close()
+            return
+        Connection(self.server, pair[0], pair[1])
+
+class Connection(asyncore.dispatcher):
+    def __init__(self, server, sock, address):
+        asyncore.dispatcher.__init__(self, sock, map=server.map)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server = server
+        self.address = address
+        self.data = ""
+        # Requests answered so far and when the client was last heard of
+        self.requests = 0
+        self.lastactive = time.time()
+        # Set while the connection is parked waiting for events, or queued
+        # waiting for a turn of the EndpointLimit queuedfor
+        self.request = None
+        self.start = None
+        self.queuedfor = None
+        self.deadline = None
+        # EndpointLimit whose turn the request being handled holds
+        self.slot = None
+        # Set while the loop sends a response body: the stream, the bytes
+        # of it still to go and whether to keep the connection afterwards
+        self.body = None
+        self.remaining = 0
+        self.keepalive = False
+        self.chunk = ""
+        self.offset = 0
+
+    def writable(self):
+        return self.body is not None
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if data:
+            self.lastactive = time.time()
+            self.data = self.data + data
+            if self.request is None and self.body is None:
+                self.server.check(self)
+
+    # Takes over the rest of a response, the headers of which are out
+    def send_body(self, body, length, keepalive):
+        self.body = body
+        self.remaining = length
+        self.keepalive = keepalive
+
+    def handle_write(self):
+        # Closed by handle_read() in the same round of the loop
+        if self.body is None:
+            return
+        if self.offset == len(self.chunk):
+            self.chunk = self.body.read(min(self.remaining, WRITECHUNK))
+            self.offset = 0
+            if not self.chunk:
+                # Shorter than its Content-Length, the client can only
+                # tell from the connection going away
+                self.handle_close()
+                return
+        sent = self.send(buffer(self.chunk, self.offset))
+        if not sent:
+            return
+        self.lastactive = time.time()
+        self.offset = self.offset + sent
+        self.remaining = self.remaining - sent
+        if self.remaining == 0:
+            self.end_body()
+            if self.keepalive:
+                self.server.check(self)
+            else:
+                self.handle_close()
+
+    def end_body(self):
+        if self.body is not None:
+            self.body.close()
+            self.body = None
+        self.chunk = ""
+        self.offset = 0
+        self.server.release_slot(self)
+
+    def handle_error(self):
+        print "Error sending response to %s:" % (self.address,)
+        traceback.print_exc(file=sys.stdout)
+        self.handle_close()
+
+    def handle_close(self):
+        self.server.forget(self)
+        self.close()
+
+    def close(self):
+        if self.socket is not None:
+            self.server.remove_connection()
+            asyncore.dispatcher.close(self)
+            self.socket = None
+        self.end_body()
+
+    # Splits the first complete request off the data read so far, None if
+    # it has not all arrived yet
+    def next_request(self):
+        self.data = self.data.lstrip("\r\n")
+        match = HEADEREND.search(self.data)
+        if match is None:
+            if len(self.data) > MAXHEADERSIZE:
+                raise ValueError("request header too long")
+            return None
+        end = match.end()
+        length = 0
+        for line in self.data[:end].split("\n")[1:]:
+            name, sep, value = line.partition(":")
+            if name.strip().lower() == "content-length":
+                length = int(value)
+        if len(self.data) < end + length:
+            return None
+        request = self.data[:end + length]
+        self.data = self.data[end + length:]
+        return request
+
+# Serves requests like SocketServer's servers do, with serve_forever()
+# running the loop and shutdown() stopping it from another thread.
+# threads is the number of workers handling requests. Connections beyond
+# max_connections, if it is not None, are sent overloaded and closed.
+class AsyncHTTPServer(object):
+    def __init__(self, server_address, RequestHandlerClass, threads=16, max_connections=None):
+        self.map = {}
+        self.max_connections = max_connections
+        # Connections that have not sent a request for this long are
+        # closed, None to keep them forever
+        self.idle_timeout = RequestHandlerClass.timeout
+        self.idlecheck = 0
+        self.overloaded = "HTTP/1.1 503 Service Unavailable\r\nRetry-After: %d\r\nContent-Length: 0\r\nConnection: close\r\n\r\n" % RequestHandlerClass.retry_after
+        self.connections = 0
+        self.RequestHandlerClass = make_handler(RequestHandlerClass)
+        # How long a request for events may be parked, None for no limit
+        self.maxwait = RequestHandlerClass.lastevents_maxwait
+        self.listener = Listener(self, server_address)
+        self.server_address = self.listener.socket.getsockname()
+        self.waker = None
+        self.threads = threads
+        self.lock = threading.Lock()
+        self.resumed = []
+        # Parked connection -> event number it waits to go past
+        self.parked = {}
+        # EndpointLimit -> connections waiting for a turn, in order
+        self.queued = {}
+        self.latest = None
+        self.deadlines = []
+        self.jobs = Queue.Queue()
+        self.stopping = False
+        self.stopped = threading.Event()
+
+    # Threads and the wake-up pipe only come to life here, so a server can
+    # be created and then shared by processes forked off afterwards
+    def start(self):
+        self.waker = Waker(self.map)
+        for x in range(self.threads):
+            worker = threading.Thread(target=self.work, name="Worker %d" % x)
+            worker.daemon = True
+            worker.start()
+        gitmer.eventwatcher.add_listener(self.waker.wake)
+
+    def serve_forever(self):
+        if self.waker is None:
+            self.start()
+        self.stopped.clear()
+        try:
+            while not self.stopping:
+                asyncore.loop(self.timeout(), True, self.map, 1)
+                self.resume_connections()
+                self.admit_queued()
+                self.wake_parked()
+                self.close_idle()
+        finally:
+            self.stopping = False
+            self.stopped.set()
+
+    def shutdown(self):
+        self.stopping = True
+        self.waker.wake()
+        self.stopped.wait()
+
+    def add_connection(self):
+        self.lock.acquire()
+        try:
+            if self.max_connections is not None and self.connections >= self.max_connections:
+                return False
+            self.connections = self.connections + 1
+            return True
+        finally:
+            self.lock.release()
+
+    def remove_connection(self):
+        self.lock.acquire()
+        try:
+            self.connections = self.connections - 1
+        finally:
+            self.lock.release()
+
+    # Seconds until the next parked request runs out of time
+    def timeout(self):
+        timeout = None
+        if self.deadlines:
+            timeout = max(self.deadlines[0][0] - time.time(), 0)
+        if self.idle_timeout is not None and (timeout is None or timeout > 1):
+            timeout = 1
+        return timeout
+
+    def close_idle(self):
+        now = time.time()
+        if self.idle_timeout is None or now - self.idlecheck < 1:
+            return
+        self.idlecheck = now
+        for conn in self.map.values():
+            if isinstance(conn, Connection) and conn.request is None and now - conn.lastactive > self.idle_timeout:
+                conn.handle_close()
+
+    # Runs in the loop: hands the next complete request on conn to a
+    # worker, or parks it if it is waiting for events that are not there,
+    # or queues it if its endpoint is at its limit
+    def check(self, conn):
+        try:
+            request = conn.next_request()
+        except ValueError:
+            conn.handle_close()
+            return
+        if request is None:
+            return
+        start = self.RequestHandlerClass.lastevents_start(request)
+        if start is not None and start == gitmer.eventwatcher.latest():
+            conn.request = request
+            conn.start = start
+            self.parked[conn] = start
+            if self.maxwait is not None:
+                conn.deadline = time.time() + self.maxwait
+                heapq.heappush(self.deadlines, (conn.deadline, id(conn), conn))
+            return
+        limit = self.RequestHandlerClass.request_limit(request)
+        # Nobody gets ahead of those already waiting
+        if limit is not None and (self.queued.get(limit) or not limit.try_acquire()):
+            queue = self.queued.setdefault(limit, collections.deque())
+            if len(queue) >= limit.queue:
+                self.turn_away(conn, request)
+                return
+            conn.request = request
+            conn.queuedfor = limit
+            conn.deadline = time.time() + limit.wait
+            heapq.heappush(self.deadlines, (conn.deadline, id(conn), conn))
+            queue.append(conn)
+            return
+        conn.slot = limit
+        self.dispatch(conn, request)
+
+    # Answers a request that can't be taken on with a 503, from the loop
+    def turn_away(self, conn, request):
+        print "503: endpoint is busy, turning away %s" % request.split("\n", 1)[0].strip()
+        try:
+            conn.socket.send(self.overloaded)
+        except socket.error:
+            pass
+        conn.handle_close()
+
+    def dispatch(self, conn, request):
+        conn.del_channel()
+        self.jobs.put((conn, request))
+
+    def forget(self, conn):
+        self.parked.pop(conn, None)
+        if conn.queuedfor is not None:
+            self.queued[conn.queuedfor].remove(conn)
+            conn.queuedfor = None
+
+    def unpark(self, conn):
+        del self.parked[conn]
+        request = conn.request
+        conn.request = conn.start = conn.deadline = None
+        self.dispatch(conn, request)
+
+    # Hands queued requests to workers as turns become free
+    def admit_queued(self):
+        for limit, queue in self.queued.items():
+            while queue and limit.try_acquire():
+                conn = queue.popleft()
+                request = conn.request
+                conn.request = conn.queuedfor = conn.deadline = None
+                conn.slot = limit
+                self.dispatch(conn, request)
+
+    def wake_parked(self):
+        latest = gitmer.eventwatcher.latest()
+        if latest != self.latest:
+            self.latest = latest
+            for conn, start in self.parked.items():
+                if start != latest:
+                    self.unpark(conn)
+        now = time.time()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, key, conn = heapq.heappop(self.deadlines)
+            if conn.deadline != deadline:
+                continue
+            if conn in self.parked:
+                self.unpark(conn)
+            elif conn.queuedfor is not None:
+                # Waited as long as a thread would have for its turn
+                request = conn.request
+                self.forget(conn)
+                conn.request = conn.deadline = None
+                self.turn_away(conn, request)
+
+    # Takes back connections whose request has been answered
+    def resume_connections(self):
+        self.lock.acquire()
+        try:
+            resumed = self.resumed
+            self.resumed = []
+        finally:
+            self.lock.release()
+        for conn in resumed:
+            conn.lastactive = time.time()
+            conn.socket.setblocking(0)
+            conn.set_socket(conn.socket)
+            if conn.body is None:
+                self.check(conn)
+
+    # Gives back the turn conn's request held, once it has been answered
+    def release_slot(self, conn):
+        if conn.slot is not None:
+            conn.slot.release()
+            conn.slot = None
+            # Someone queued may have its turn now
+            self.waker.wake()
+
+    def work(self):
+        while True:
+            conn, request = self.jobs.get()
+            keepalive = False
+            try:
+                conn.socket.setblocking(1)
+                handler = self.RequestHandlerClass(conn.socket, conn.address, self, request, conn.requests)
+                conn.requests = handler.requests
+                keepalive = not handler.close_connection
+                if handler.handedover is not None:
+                    conn.send_body(handler.handedover, handler.contentlength, keepalive)
+            except Exception:
+                print "Error handling request from %s:" % (conn.address,)
+                traceback.print_exc(file=sys.stdout)
+            if conn.body is not None:
+                # The loop sends the rest and closes the connection if need be
+                keepalive = True
+            else:
+                self.release_slot(conn)
+            if not keepalive:
+                conn.close()
+                continue
+            self.lock.acquire()
+            try:
+                self.resumed.append(conn)
+            finally:
+                self.lock.release()
+            self.waker.wake()
+
+    # Request lines of the parked and queued requests, for thread dumps
+    def parked_requests(self):
+        conns = self.parked.keys()
+        for queue in self.queued.values():
+            conns.extend(queue)
+        return [x.request.split("\n", 1)[0].strip() for x in conns if x.request is not None]
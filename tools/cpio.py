@@ -0,0 +1,276 @@
+# Builds "newc" cpio archives the way `cpio -o -H newc -C 8192` does,
+# byte for byte, without running cpio or holding the archive in memory,
+# and unpacks them again.
+
+import os
+import stat
+import hashlib
+from collections import namedtuple
+
+NEWC_MAGIC = "070701"
+TRAILER = "TRAILER!!!"
+BLOCKSIZE = 8192
+
+def pad4(length):
+    return (4 - length % 4) % 4
+
+# One member header plus its name and padding. GNU cpio prints the fields
+# as 8 digit upper case hex and leaves the checksum at 0 for newc.
+def newc_header(name, ino=0, mode=0, uid=0, gid=0, nlink=1, mtime=0, filesize=0,
+                devmajor=0, devminor=0, rdevmajor=0, rdevminor=0):
+    fields = (ino, mode, uid, gid, nlink, mtime, filesize,
+              devmajor, devminor, rdevmajor, rdevminor, len(name) + 1, 0)
+    header = NEWC_MAGIC + "".join(["%08X" % (x & 0xffffffff) for x in fields]) + name + "\0"
+    return header + "\0" * pad4(len(header))
+
+def stat_header(name, st, filesize):
+    return newc_header(name, st.st_ino, st.st_mode, st.st_uid, st.st_gid, st.st_nlink,
+                       int(st.st_mtime), filesize,
+                       os.major(st.st_dev), os.minor(st.st_dev),
+                       os.major(st.st_rdev), os.minor(st.st_rdev))
+
+# Archive of the given file names inside directory, read out as a file-like
+# object. Everything is stat()ed up front so the total size is known before
+# the first byte is sent; file contents are only read while streaming.
+# Names that do not exist are left out, like cpio does after complaining.
+class ArchiveStream(object):
+    def __init__(self, directory, names, blocksize=BLOCKSIZE):
+        # Pieces are either strings (headers, padding, symlink targets)
+        # or (path, size) for file contents
+        self.pieces = []
+        self.size = 0
+        digest = hashlib.md5()
+        # Regular files with more than one link are held back until their
+        # last link is seen, newest first, as cpio does for newc
+        deferred = []
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                print "cpio: %s: no such file" % name
+                continue
+            if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+                links = [x for x in deferred if self.same_inode(x[1], st)]
+                if len(links) + 1 < st.st_nlink:
+                    deferred.insert(0, (name, st))
+                    continue
+                for x in links:
+                    self.add_member(x[0], os.path.join(directory, x[0]), x[1], digest, False)
+                    deferred.remove(x)
+            self.add_member(name, path, st, digest)
+        while deferred:
+            name, st = deferred.pop(0)
+            links = [x for x in deferred if self.same_inode(x[1], st)]
+            self.add_member(name, os.path.join(directory, name), st, digest, not links)
+        self.add(newc_header(TRAILER))
+        if self.size % blocksize:
+            self.add("\0" * (blocksize - self.size % blocksize))
+        # Headers carry inode, size and mtime of every member, so their
+        # digest changes whenever the archive would
+        self.etag = '"%s"' % digest.hexdigest()
+        self.piece = 0
+        self.offset = 0
+        self.current = None
+
+    def same_inode(self, a, b):
+        return a.st_ino == b.st_ino and a.st_dev == b.st_dev
+
+    def add(self, piece):
+        self.pieces.append(piece)
+        if isinstance(piece, tuple):
+            self.size = self.size + piece[1]
+        else:
+            self.size = self.size + len(piece)
+
+    def add_member(self, name, path, st, digest, withdata=True):
+        data = None
+        filesize = 0
+        if withdata:
+            if stat.S_ISREG(st.st_mode):
+                filesize = st.st_size
+                data = (path, filesize)
+            elif stat.S_ISLNK(st.st_mode):
+                data = os.readlink(path)
+                filesize = len(data)
+        header = stat_header(name, st, filesize)
+        digest.update(header)
+        self.add(header)
+        if filesize:
+            self.add(data)
+            if pad4(filesize):
+                self.add("\0" * pad4(filesize))
+
+    # Reads from a file piece, padding with zeros if the file shrunk
+    # since it was stat()ed, which is what cpio does too
+    def read_file(self, path, length):
+        if self.current is None:
+            self.current = open(path, "rb")
+        data = self.current.read(length)
+        if len(data) < length:
+            data = data + "\0" * (length - len(data))
+        return data
+
+    def read(self, size=-1):
+        chunks = []
+        while self.piece < len(self.pieces) and size != 0:
+            piece = self.pieces[self.piece]
+            if isinstance(piece, tuple):
+                left = piece[1] - self.offset
+            else:
+                left = len(piece) - self.offset
+            if size < 0 or size > left:
+                length = left
+            else:
+                length = size
+            if isinstance(piece, tuple):
+                if size < 0:
+                    length = min(length, 64 * 1024)
+                chunks.append(self.read_file(piece[0], length))
+            else:
+                chunks.append(piece[self.offset:self.offset + length])
+            if size > 0:
+                size = size - length
+            if length == left:
+                self.next_piece()
+            else:
+                self.offset = self.offset + length
+        return "".join(chunks)
+
+    def next_piece(self):
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+        self.piece = self.piece + 1
+        self.offset = 0
+
+    # Writes the whole archive to outputfile, handing file contents to
+    # sendfile(f, offset, count, outputfile) where it can take them
+    def copyto(self, outputfile, sendfile=None):
+        assert self.piece == 0 and self.offset == 0
+        for piece in self.pieces:
+            if not isinstance(piece, tuple):
+                outputfile.write(piece)
+                continue
+            path, size = piece
+            f = open(path, "rb")
+            try:
+                if sendfile is not None and size > 0 and os.fstat(f.fileno()).st_size >= size \
+                        and sendfile(f, 0, size, outputfile):
+                    continue
+                while size > 0:
+                    data = f.read(min(size, 64 * 1024))
+                    if not data:
+                        data = "\0" * min(size, 64 * 1024)
+                    outputfile.write(data)
+                    size = size - len(data)
+            finally:
+                f.close()
+        self.piece = len(self.pieces)
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+        self.piece = len(self.pieces)
+
+# Reading archives back, as `cpio -idm` does
+
+NewcHeader = namedtuple("NewcHeader", "name ino mode uid gid nlink mtime filesize "
+                                      "devmajor devminor rdevmajor rdevminor")
+
+def read_exactly(fileobj, length):
+    chunks = []
+    while length > 0:
+        data = fileobj.read(length)
+        if not data:
+            raise ValueError("cpio archive is truncated")
+        chunks.append(data)
+        length = length - len(data)
+    return "".join(chunks)
+
+# Reads the next member header and name, None once the trailer is reached.
+# The member's data and padding are left for the caller to read.
+def read_header(fileobj):
+    header = read_exactly(fileobj, 110)
+    if header[:6] not in (NEWC_MAGIC, "070702"):
+        raise ValueError("not a newc cpio archive")
+    fields = [int(header[6 + x * 8:14 + x * 8], 16) for x in range(13)]
+    namesize = fields[11]
+    name = read_exactly(fileobj, namesize + pad4(110 + namesize))[:namesize - 1]
+    if name == TRAILER:
+        return None
+    return NewcHeader(name, *fields[:11])
+
+def copy_data(fileobj, outputfile, length):
+    while length > 0:
+        data = read_exactly(fileobj, min(length, 64 * 1024))
+        if outputfile is not None:
+            outputfile.write(data)
+        length = length - len(data)
+
+# Unpacks the archive read from fileobj into directory, keeping modes and
+# modification times. Regular files are written under a temporary name and
+# renamed into place once complete, so an interrupted run never leaves a
+# truncated file behind. Returns the names of the members unpacked; reading
+# stops after the trailer, any block padding is left in fileobj.
+def extract(fileobj, directory, verbose=False):
+    names = []
+    # (dev, inode) -> names of hard links that came without data, as newc
+    # sends the data with the last link only
+    links = {}
+    while True:
+        header = read_header(fileobj)
+        if header is None:
+            break
+        name = os.path.normpath(header.name)
+        if name.startswith("/") or name == ".." or name.startswith("../"):
+            raise ValueError("cpio: refusing to unpack %s" % header.name)
+        path = os.path.join(directory, name)
+        parent = os.path.dirname(path)
+        if parent and not os.path.isdir(parent):
+            os.makedirs(parent)
+        key = (header.devmajor, header.devminor, header.ino)
+        if stat.S_ISREG(header.mode):
+            if header.nlink > 1 and header.filesize == 0:
+                links.setdefault(key, []).append((path, header))
+            else:
+                write_file(fileobj, path, header)
+                link_to(path, links.pop(key, []))
+        elif stat.S_ISDIR(header.mode):
+            if not os.path.isdir(path):
+                os.mkdir(path)
+            os.chmod(path, stat.S_IMODE(header.mode))
+        elif stat.S_ISLNK(header.mode):
+            target = read_exactly(fileobj, header.filesize)
+            if os.path.lexists(path):
+                os.unlink(path)
+            os.symlink(target, path)
+        else:
+            print "cpio: %s: skipping unsupported file type" % header.name
+            copy_data(fileobj, None, header.filesize)
+        read_exactly(fileobj, pad4(header.filesize))
+        if verbose:
+            print name
+        names.append(name)
+    # Links to an empty file never get a member with data
+    for paths in links.values():
+        write_file(fileobj, paths[0][0], paths[0][1])
+        link_to(paths[0][0], paths[1:])
+    return names
+
+def write_file(fileobj, path, header):
+    f = open(path + ".part", "wb")
+    try:
+        copy_data(fileobj, f, header.filesize)
+    finally:
+        f.close()
+    os.chmod(path + ".part", stat.S_IMODE(header.mode))
+    os.utime(path + ".part", (header.mtime, header.mtime))
+    os.rename(path + ".part", path)
+
+def link_to(path, links):
+    for x, header in links:
+        if os.path.lexists(x):
+            os.unlink(x)
+        os.link(path, x)
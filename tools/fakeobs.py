@@ -22,88 +22,456 @@ import mimetypes
 import urlparse
 import uuid
 import gitmer
-import subprocess
-import xml.dom.minidom
+import cpio
+import asyncserver
 import os
 import traceback
 import threading
 import signal
+import optparse
+import email.utils
+import hashlib
+import mmap
+import errno
+import socket
+import re
 
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
 
+# Serves length bytes of stream starting at offset first
+class RangeStream(object):
+    def __init__(self, stream, first, length):
+        self.stream = stream
+        self.first = first
+        self.remaining = length
+        if hasattr(stream, "seek"):
+            stream.seek(first)
+        else:
+            while first > 0:
+                skipped = len(stream.read(min(first, 64 * 1024)))
+                if skipped == 0:
+                    break
+                first = first - skipped
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if size == 0:
+            return ""
+        data = self.stream.read(size)
+        self.remaining = self.remaining - len(data)
+        return data
+
+    def close(self):
+        self.stream.close()
+
+def string2stream(thestr):
+    content = StringIO()
+    content.write(thestr)
+    content.seek(0, os.SEEK_END)
+    contentsize = content.tell()
+    content.seek(0, os.SEEK_SET)
+    return contentsize, content
+
+def file2stream(path):
+    f = open(path, 'rb')
+    fs = os.fstat(f.fileno())
+    return fs[6], fs.st_mtime, f
+
+# What a route handler returns for a 404
+NOTFOUND = (None, 0, None, None, None)
+
+# Lets at most limit requests of one kind run at the same time. Up to queue
+# more wait at most wait seconds for their turn, the rest are turned away.
+class EndpointLimit(object):
+    def __init__(self, limit, queue, wait=30):
+        self.limit = limit
+        self.queue = queue
+        self.wait = wait
+        self.condition = threading.Condition(threading.Lock())
+        self.running = 0
+        self.waiting = 0
+
+    # True once the request may run, False if it has to be turned away
+    def acquire(self):
+        self.condition.acquire()
+        try:
+            if self.running < self.limit:
+                self.running = self.running + 1
+                return True
+            if self.waiting >= self.queue:
+                return False
+            self.waiting = self.waiting + 1
+            try:
+                deadline = time.time() + self.wait
+                while self.running >= self.limit:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+                self.running = self.running + 1
+                return True
+            finally:
+                self.waiting = self.waiting - 1
+        finally:
+            self.condition.release()
+
+    # Takes a turn if there is one free right away, for an event loop that
+    # keeps the waiting requests itself
+    def try_acquire(self):
+        self.condition.acquire()
+        try:
+            if self.running < self.limit:
+                self.running = self.running + 1
+                return True
+            return False
+        finally:
+            self.condition.release()
+
+    def release(self):
+        self.condition.acquire()
+        try:
+            self.running = self.running - 1
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+# Sent to connections that can not be taken on at all
+OVERLOADED = "HTTP/1.1 503 Service Unavailable\r\nRetry-After: %d\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+
 class SimpleHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     server_version = "fakeobs/" + __version__
     protocol_version = 'HTTP/1.1'
+    # Longest time in seconds a /public/lastevents request is held open
+    # waiting for new events, None to wait until there are some
+    lastevents_maxwait = None
+    # Endpoint name -> EndpointLimit for the requests it serves, endpoints
+    # without one are not limited
+    limits = {}
+    # Seconds clients are told to wait when a limit turns them away
+    retry_after = 5
+
+    # Seconds a connection may wait for the next request, or for any read
+    # or write within one, before it is closed. None for no limit.
+    timeout = 300
+    # Requests answered on a connection before it is closed, None for no
+    # limit
+    max_requests = 1000
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        # Headers and small bodies go out as separate writes, don't let
+        # them wait for the client's delayed ACK
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.requests = 0
+        self.bodyread = False
+        self.headerlines = None
 
     def do_GET(self):
         """Serve a GET request."""
-        f = None
-        try:
-            f = self.send_head()
-        except: 
-            self.send_response(500)
-            print "500: " + self.path
-            traceback.print_exc(file=sys.stdout)
-            self.end_headers()
-        if f:
-            self.copyfile(f, self.wfile)
-            if hasattr(f, "close"):
-               f.close()
+        self.respond(True)
 
     def do_HEAD(self):
         """Serve a HEAD request."""
-        f = self.send_head()
-        if f:
-          if hasattr(f, "close"):
-            f.close()
+        self.respond(False)
 
     def do_POST(self):
-        f = self.send_head()
-        if f:
-          self.copyfile(f, self.wfile)
-          if hasattr(f, "close"):
-            f.close()             
+        self.respond(True)
 
-    # Always returns a stream
-    def send_head(self):
-        def lookup_path(projectname):
-            doc = xml.dom.minidom.parse("mappings.xml")            
-            for x in doc.getElementsByTagName("mapping"):
-                if x.attributes["project"].value == projectname:
-                    return x.attributes["path"].value
+    # Answers the request, leaving out the body for withbody False
+    def respond(self, withbody):
+        f = None
+        self.slot = None
+        self.responded = False
+        try:
+            if not self.read_body():
+                return
+            try:
+                f = self.send_head()
+            except gitmer.Busy:
+                print "503: %s, turning away %s" % (sys.exc_info()[1], self.path)
+                if self.responded:
+                    self.close_connection = 1
+                else:
+                    self.send_response(503)
+                    self.send_header("Retry-After", self.retry_after)
+                    self.send_header("Content-Length", 0)
+                    self.end_headers()
+            except: 
+                print "500: " + self.path
+                traceback.print_exc(file=sys.stdout)
+                if self.responded:
+                    # Too late to say anything, the client can only tell
+                    # from the connection going away
+                    self.close_connection = 1
+                else:
+                    self.send_error(500)
+            if f and withbody and self.hand_over_body(f):
+                f = None
+            if f:
+                try:
+                    if withbody:
+                        self.copyfile(f, self.wfile)
+                finally:
+                    if hasattr(f, "close"):
+                        f.close()
+        finally:
+            self.release_slot()
+
+    # Reads the request body, if any, into self.body before anything is
+    # answered, so whatever the answer the connection is ready for the next
+    # request. False if it could not be read and an error has been sent.
+    def read_body(self):
+        self.body = None
+        if self.headers.getheader('Transfer-Encoding', 'identity').lower() != 'identity':
+            self.send_error(411)
+            return False
+        length = self.headers.getheader('Content-Length')
+        if length is not None:
+            try:
+                length = int(length)
+            except ValueError:
+                length = -1
+            if length < 0:
+                self.send_error(400, "Bad Content-Length")
+                return False
+            self.body = self.rfile.read(length)
+            if len(self.body) < length:
+                self.close_connection = 1
+                return False
+        self.bodyread = True
+        return True
+
+    # Headers are collected and sent with a single write by end_headers()
+    def send_response(self, code, message=None):
+        self.log_request(code)
+        if message is None:
+            if code in self.responses:
+                message = self.responses[code][0]
+            else:
+                message = ''
+        self.headerlines = ["%s %d %s\r\n" % (self.protocol_version, code, message)]
+        self.connectionheader = False
+        self.contentlength = None
+        self.send_header('Server', self.version_string())
+        self.send_header('Date', self.date_time_string())
+
+    def send_header(self, keyword, value):
+        self.headerlines.append("%s: %s\r\n" % (keyword, value))
+        if keyword.lower() == 'content-length':
+            self.contentlength = int(value)
+        if keyword.lower() == 'connection':
+            self.connectionheader = True
+            if value.lower() == 'close':
+                self.close_connection = 1
+            elif value.lower() == 'keep-alive':
+                self.close_connection = 0
+
+    def end_headers(self):
+        self.requests = self.requests + 1
+        if not self.connectionheader:
+            if self.max_requests is not None and self.requests >= self.max_requests:
+                self.send_header('Connection', 'close')
+            elif not self.bodyread:
+                # The request was not read to its end, nothing after it
+                # on the connection can be trusted
+                self.send_header('Connection', 'close')
+            elif not self.close_connection and self.request_version == 'HTTP/1.0':
+                self.send_header('Connection', 'keep-alive')
+        self.headerlines.append("\r\n")
+        if self.request_version != 'HTTP/0.9':
+            self.wfile.write("".join(self.headerlines))
+        self.headerlines = None
+        self.bodyread = False
+        self.responded = True
+
+    def send_error(self, code, message=None):
+        """Send and log an error reply.
+
+        Unlike BaseHTTPRequestHandler's, the reply has a Content-Length
+        and the connection is kept open if the request was read in full.
+
+        """
+        try:
+            short, explain = self.responses[code]
+        except KeyError:
+            short, explain = '???', '???'
+        if message is None:
+            message = short
+        self.log_error("code %d, message %s", code, message)
+        content = self.error_message_format % {'code': code, 'message': cgi.escape(message), 'explain': explain}
+        self.send_response(code, message)
+        self.send_header("Content-Type", self.error_content_type)
+        self.send_header("Content-Length", len(content))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(content)
+
+    # Waits for a turn among the requests to endpoint, which is given up
+    # once the response has been sent. False if there was none to be had
+    # and the client has been told to come back later.
+    def take_slot(self, endpoint):
+        limit = self.limits.get(endpoint)
+        if limit is None:
+            return True
+        if not limit.acquire():
+            print "503: %s is busy, turning away %s" % (endpoint, self.path)
+            self.send_response(503)
+            self.send_header("Retry-After", self.retry_after)
+            self.send_header("Content-Length", 0)
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = 1
+            return False
+        self.slot = limit
+        return True
+
+    # Lets a server send the body f of the response itself once the
+    # handler is done, after the headers have gone out. True if it took f
+    # over, it then closes f too.
+    def hand_over_body(self, f):
+        return False
+
+    def release_slot(self):
+        if self.slot is not None:
+            self.slot.release()
+            self.slot = None
+
+    # ETag for content generated from the file with os.stat() result st
+    def file_etag(self, st):
+        return '"%x-%x"' % (int(st.st_mtime * 1000), st.st_size)
+
+    # True if the client's copy with etag and mtime is still current, in
+    # which case a 304 has been sent and nothing else needs to be. Either
+    # may be None when the content has no stable one.
+    def not_modified(self, etag, mtime):
+        current = False
+        if self.headers.getheader('If-None-Match') is not None:
+            tags = [x.strip() for x in self.headers.getheader('If-None-Match').split(",")]
+            current = etag is not None and (etag in tags or "*" in tags)
+        elif self.headers.getheader('If-Modified-Since') is not None and mtime is not None:
+            since = email.utils.parsedate_tz(self.headers.getheader('If-Modified-Since'))
+            if since is not None:
+                current = int(mtime) <= email.utils.mktime_tz(since)
+        if current:
+            self.send_response(304)
+            if etag is not None:
+                self.send_header("ETag", etag)
+            if mtime is not None:
+                self.send_header("Last-Modified", self.date_time_string(mtime))
+            self.end_headers()
+        return current
+
+    # Returns the (first, last) byte asked for with a single Range header,
+    # None for the whole content or False if the range is unsatisfiable
+    def requested_range(self, size, etag, mtime):
+        header = self.headers.getheader('Range')
+        if header is None or not header.startswith("bytes=") or "," in header:
+            return None
+        ifrange = self.headers.getheader('If-Range')
+        if ifrange is not None:
+            ifrange = ifrange.strip()
+            if ifrange.startswith('"') or ifrange.startswith('W/'):
+                if ifrange != etag:
+                    return None
+            else:
+                since = email.utils.parsedate_tz(ifrange)
+                if mtime is None or since is None or int(mtime) != email.utils.mktime_tz(since):
+                    return None
+        first, sep, last = header[len("bytes="):].strip().partition("-")
+        try:
+            if first == "":
+                # Suffix range, the last N bytes; none of an empty body
+                if int(last) == 0 or size == 0:
+                    return False
+                return max(size - int(last), 0), size - 1
+            first = int(first)
+            if last == "":
+                last = size - 1
+            else:
+                last = min(int(last), size - 1)
+        except ValueError:
+            return None
+        if first >= size:
+            return False
+        if last < first:
+            return None
+        return first, last
+
+    # (pattern, handler, endpoint) for every kind of path served, tried in
+    # order. The endpoint names the limit that applies, see take_slot().
+    # Handlers are called with the query and the unquoted groups of the
+    # pattern. They return (content, size, type, mtime, etag), where content
+    # is None for a 404 and mtime None for generated content, or None when
+    # they have answered the request themselves.
+    routes = [
+        (re.compile(r"^/public/lastevents"), "serve_lastevents", None),
+        (re.compile(r"^/public/source/([^/]*)$"), "serve_source_project", "metadata"),
+        (re.compile(r"^/public/source/([^/]*)/([^/]*)$"), "serve_source_package", "metadata"),
+        (re.compile(r"^/public/source/([^/]*)/([^/]*)/([^/]*)$"), "serve_source_file", "source"),
+        (re.compile(r"^/public/build/([^/]*)/([^/]*)/([^/]*)/([^/]*)$"), "serve_build", "metadata"),
+    ]
+
+    # (match, handler, endpoint) of the route serving path, None if there
+    # is none
+    @classmethod
+    def find_route(cls, path, query):
+        for pattern, handler, endpoint in cls.routes:
+            match = pattern.match(path)
+            if match:
+                # Binaries are the expensive part of build requests
+                if handler == "serve_build" and query.get("view", [None])[0] == "cpio":
+                    endpoint = "cpio"
+                return match, handler, endpoint
+        return None
+
+    # Route and query of a raw request that has been read in full but not
+    # handled yet, as send_head() will find them. The route is None if no
+    # route serves the request.
+    @classmethod
+    def request_route(cls, request):
+        head, body = re.split(r"\r?\n\r?\n", request, 1)
+        words = head.split("\n", 1)[0].split()
+        if len(words) < 2:
+            return None, {}
+        pathparsed = urlparse.urlparse(words[1])
+        if re.search(r"(?im)^content-length:", head):
+            query = urlparse.parse_qs(body)
+        else:
+            query = urlparse.parse_qs(pathparsed[4])
+        return cls.find_route(pathparsed[2], query), query
+
+    # The event number a raw /public/lastevents request waits to go past,
+    # None for any other request. Lets an event loop park it for later.
+    @classmethod
+    def lastevents_start(cls, request):
+        route, query = cls.request_route(request)
+        if route is None or route[1] != "serve_lastevents":
+            return None
+        try:
+            return int(query["start"][0])
+        except (KeyError, ValueError):
             return None
-        def lookup_binariespath(projectname):
-            doc = xml.dom.minidom.parse("mappings.xml")            
-            for x in doc.getElementsByTagName("mapping"):
-                if x.attributes["project"].value == projectname:
-                    return x.attributes["binaries"].value
+
+    # The EndpointLimit a raw request counts against, None if it has none.
+    # Lets an event loop hold the request back until it may run.
+    @classmethod
+    def request_limit(cls, request):
+        route, query = cls.request_route(request)
+        if route is None:
             return None
-        def string2stream(thestr):
-            content = StringIO()
-            content.write(thestr)
-            content.seek(0, os.SEEK_END)
-            contentsize = content.tell()
-            content.seek(0, os.SEEK_SET)
-            return contentsize, content
-        def file2stream(path):
-            f = open(path, 'rb')
-            fs = os.fstat(f.fileno())
-            return fs[6], fs.st_mtime, f
-                    
-        content = None
-        contentsize = 0
-        contentmtime = 0
-        contenttype = None
+        return cls.limits.get(route[2])
 
+    # Always returns a stream
+    def send_head(self):
         pathparsed = urlparse.urlparse(self.path)
         path = pathparsed[2] 
 
-        if self.headers.getheader('Content-Length') is not None:
-            data = self.rfile.read(int(self.headers.getheader('Content-Length')))
-            query = urlparse.parse_qs(data)
+        if self.body is not None:
+            query = urlparse.parse_qs(self.body)
         elif pathparsed[4] is not None:
             query = urlparse.parse_qs(pathparsed[4])
         else:
@@ -111,191 +479,215 @@ class SimpleHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
         threading.current_thread().name = self.path
 
-        if path.startswith("/public/lastevents"):
-            if query.has_key("start"):
-                filters = []
-                
-                if query.has_key("filter"):
-                    for x in query["filter"]:
-                        spl = x.split('/')
-                        if len(spl) == 2:
-                            filters.append((urllib.unquote(spl[0]), urllib.unquote(spl[1]), None))
-                        else:
-                            filters.append((urllib.unquote(spl[0]), urllib.unquote(spl[1]), urllib.unquote(spl[2])))
-
-                if "obsname" in query:
-                    threading.current_thread().name = "%s Watcher" % query["obsname"][0]
-
-                print "%s: will poll every 10 seconds" % threading.current_thread().name
-
-                while int(query["start"][0]) == gitmer.get_next_event():
-                    time.sleep(10)
+        result = NOTFOUND
+        route = self.find_route(path, query)
+        if route is not None:
+            match, handler, endpoint = route
+            if not self.take_slot(endpoint):
+                return None
+            args = [urllib.unquote(x) for x in match.groups()]
+            result = getattr(self, handler)(query, *args)
+        if result is None:
+            return None
+        content, contentsize, contenttype, contentmtime, contentetag = result
 
-                contentsize, content = string2stream(gitmer.get_events_filtered(int(query["start"][0]), filters))
-                contenttype = "text/html"
-                contentmtime = time.time()
-            else:
-                output = '<events next="' + str(gitmer.get_next_event()) + '" sync="lost" />\n'
-                
-                contentsize, content = string2stream(output)
-                contenttype = "text/html"
-                contentmtime = time.time()
-            
-        elif path.startswith("/public/source/"):
-            pathparts = path.split("/")
-            pathparts = pathparts[1:]
-            for x in range(0, len(pathparts)):
-                pathparts[x] = urllib.unquote(pathparts[x])
-            realproject = None
-            if len(pathparts) >= 3:
-               realproject = pathparts[2]
-               pathparts[2] = lookup_path(pathparts[2])
-               
-               if pathparts[2] is None:
-                    pathparts[2] = "--UNKNOWNPROJECT"
-            
-            # /source/project/
-            if len(pathparts) == 3:
-                if os.path.isfile(pathparts[2] + "/packages.xml"):
-                      contentsize, content = string2stream(gitmer.build_project_index(pathparts[2]))
-                      contenttype = "text/xml"
-                      contentmtime = time.time()
-            # package or metadata for project
-            elif len(pathparts) == 4:
-                if pathparts[3] == "_config":
-                    contentsize, contentmtime, content = file2stream(pathparts[2] + "/" + pathparts[3])
-                    contenttype = "text/plain"
-                elif pathparts[3] == "_meta":
-                    contentsize, content = string2stream(gitmer.adjust_meta(pathparts[2], realproject))
-                    contenttype = "text/xml"
-                    contentmtime = time.time()
-                elif pathparts[3] == "_pubkey":
-                    content = None # 404 it
-                elif pathparts[3] == "_pattern":
-                    content = None # 404 it
-                else:
-                    expand = 0
-                    rev = None
-                    if query.has_key("expand"):
-                        expand = int(query["expand"][0])
-                    if query.has_key("rev"):
-                        rev = query["rev"][0]
-                    
-                    contentsize, content = string2stream(gitmer.get_package_index_supportlink(pathparts[2], pathparts[3], rev, expand))
-                    contenttype = "text/xml"
-                    contentmtime = time.time()
-            elif len(pathparts) == 5:
-                rev = None
-                expand = 0
-                if query.has_key("expand"):
-                        expand = int(query["expand"][0])
-                if query.has_key("rev"):
-                        rev = query["rev"][0]
-                contentsize, contentst = gitmer.get_package_file(realproject, pathparts[2], pathparts[3], pathparts[4], rev)
-                contentz, content = string2stream(contentst)
-                contenttype = "application/octet-stream"
-                contentmtime = time.time()
-        elif path.startswith("/public/build"):
-            pathparts = path.split("/")
-            pathparts = pathparts[1:]
-
-            #/public/build/Mer:Trunk:Base/standard/i586/_repository?view=cache
-            if len(pathparts) >= 3:
-                pathparts[2] = lookup_binariespath(pathparts[2])
-                if pathparts[2] is None:
-                    pathparts[2] = "--UNKNOWNPROJECT"
-            if len(pathparts) == 6 and pathparts[5] != "_repository":
-                if not isinstance(query.get("binary", None), list):
-                    query["binary"] = []
-                query["binary"].append(pathparts[5])
-                    
-                if not isinstance(query.get("view", None), list):
-                    query["view"] = ["names"]
-
-                pathparts[5] = "_repository"
-
-            print pathparts
-            print query
-
-            if len(pathparts) == 6 and pathparts[5] == "_repository":
-                # pathparts[2]  == project
-                #          [3]  == repository
-                #          [4]  == scheduler
-                if query.has_key("view") and query["view"][0] == "cache":
-                    if os.path.isfile(pathparts[2] + "/" + pathparts[3] + "/" + pathparts[4] + "/_repository?view=cache"):
-                        contentsize, contentmtime, content = file2stream(pathparts[2] + "/" + pathparts[3] + "/" + pathparts[4] + "/_repository?view=cache")
-                        contenttype = "application/octet-stream"
-                    else:
-                        contentsize, contentmtime, content = file2stream("tools/emptyrepositorycache.cpio")
-                        contenttype = "application/octet-stream"
-                elif query.has_key("view") and query["view"][0] == "solvstate":
-                    if os.path.isfile(pathparts[2] + "/" + pathparts[3] + "/" + pathparts[4] + "/_repository?view=solvstate"):
-                        contentsize, contentmtime, content = file2stream(pathparts[2] + "/" + pathparts[3] + "/" + pathparts[4] + "/_repository?view=solvstate")
-                        contenttype = "application/octet-stream"
-                    else:
-                        contentsize, contentmtime, content = file2stream("tools/emptyrepositorycache.cpio")
-                        contenttype = "application/octet-stream"
-                elif query.has_key("view") and query["view"][0] == "cpio":
-                    binaries = ""
-                    for x in query["binary"]:
-                        if os.path.isfile(pathparts[2] + "/" + pathparts[3] + "/" + pathparts[4] + "/" + os.path.basename(x) + ".rpm"):
-                            assert "" + pathparts[2] + "/" + pathparts[3] + "/" + pathparts[4] + "/" + os.path.basename(x) + ".rpm was not found"
-                        binaries = binaries + os.path.basename(x) + ".rpm\n"
-                    
-                    print binaries
-
-                    cpiooutput = subprocess.Popen(["tools/createcpio", pathparts[2] + "/" + pathparts[3] + "/" + pathparts[4]], stdin=subprocess.PIPE, stdout=subprocess.PIPE).communicate(binaries)[0]
-                    contentsize, content = string2stream(cpiooutput)
-                    print contentsize
-                    contentmtime = time.time()
-                    contenttype = "application/x-cpio"
-                    ##
-                elif query.has_key("view") and query["view"][0] == "names":
-                    if os.path.isfile(pathparts[2] + "/" + pathparts[3] + "/" + pathparts[4] + "/_repository?view=names"):
-                        doc = xml.dom.minidom.parse(pathparts[2] + "/" + pathparts[3] + "/" + pathparts[4] + "/_repository?view=names")
-                        removables = []
-                        for x in doc.getElementsByTagName("binary"):
-                            if not os.path.splitext(x.attributes["filename"].value)[0] in query["binary"]:
-                                removables.append(x)
-                        for x in removables:
-                            doc.childNodes[0].removeChild(x)
-                        contentsize, content = string2stream(doc.childNodes[0].toxml())
-                        contentmtime = time.time()
-                        contenttype = "text/html"                    
-                    else:
-                        contentsize, content = string2stream("<binarylist />")
-                        contenttype = "text/html"
-                        contentmtime = time.time()
-                    ##
-                elif query.has_key("view") and query["view"][0] == "binaryversions":                   
-                    if os.path.isfile(pathparts[2] + "/" + pathparts[3] + "/" + pathparts[4] + "/_repository?view=cache"):
-                        doc = xml.dom.minidom.parse(pathparts[2] + "/" + pathparts[3] + "/" + pathparts[4] + "/_repository?view=binaryversions")
-                        removables = []
-                        for x in doc.getElementsByTagName("binary"):
-                            if not os.path.splitext(x.attributes["name"].value)[0] in query["binary"]:
-                                removables.append(x)
-                        for x in removables:
-                            doc.childNodes[0].removeChild(x)
-                        contentsize, content = string2stream(doc.childNodes[0].toxml())
-                        contentmtime = time.time()
-                        contenttype = "text/html"                    
-                    else:
-                        contentsize, content = string2stream("<binaryversionlist />")
-                        contenttype = "text/html"
-                        contentmtime = time.time()
-                
         if content is None:
               print "404: path"
               self.send_error(404, "File not found")
               return None
               
-        self.send_response(200)
+        if contentetag is None:
+            if isinstance(content, file):
+                contentetag = self.file_etag(os.fstat(content.fileno()))
+            elif hasattr(content, "getvalue") and contentsize <= 1024 * 1024:
+                contentetag = '"%s"' % hashlib.md5(content.getvalue()).hexdigest()
+        if self.not_modified(contentetag, contentmtime):
+            content.close()
+            return None
+
+        byterange = self.requested_range(contentsize, contentetag, contentmtime)
+        if byterange is False:
+            content.close()
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%d" % contentsize)
+            self.send_header("Content-Length", 0)
+            self.end_headers()
+            return None
+
+        if byterange is None:
+            self.send_response(200)
+            self.send_header("Content-Length", contentsize)
+        else:
+            first, last = byterange
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (first, last, contentsize))
+            self.send_header("Content-Length", last - first + 1)
+            content = RangeStream(content, first, last - first + 1)
         self.send_header("Content-type", contenttype)
-        self.send_header("Content-Length", contentsize)
+        if contentmtime is None:
+            contentmtime = time.time()
         self.send_header("Last-Modified", self.date_time_string(contentmtime))
+        if contentetag is not None:
+            self.send_header("ETag", contentetag)
+        self.send_header("Accept-Ranges", "bytes")
         self.end_headers()
         return content
 
+    def serve_lastevents(self, query):
+        if query.has_key("start"):
+            filters = []
+            
+            if query.has_key("filter"):
+                for x in query["filter"]:
+                    spl = x.split('/')
+                    if len(spl) == 2:
+                        filters.append((urllib.unquote(spl[0]), urllib.unquote(spl[1]), None))
+                    else:
+                        filters.append((urllib.unquote(spl[0]), urllib.unquote(spl[1]), urllib.unquote(spl[2])))
+
+            if "obsname" in query:
+                threading.current_thread().name = "%s Watcher" % query["obsname"][0]
+
+            print "%s: waiting for events" % threading.current_thread().name
+
+            gitmer.eventwatcher.wait(int(query["start"][0]), self.lastevents_maxwait)
+
+            contentsize, content = string2stream(gitmer.get_events_filtered(int(query["start"][0]), filters))
+        else:
+            output = '<events next="' + str(gitmer.get_next_event()) + '" sync="lost" />\n'
+            
+            contentsize, content = string2stream(output)
+        return content, contentsize, "text/html", None, None
+
+    # /source/project/
+    def serve_source_project(self, query, project):
+        mapping = gitmer.get_project_mapping(project)
+        if mapping is None or mapping.path is None or not os.path.isfile(mapping.path + "/packages.xml"):
+            return NOTFOUND
+        st = os.stat(mapping.path + "/packages.xml")
+        contentetag = self.file_etag(st)
+        if self.not_modified(contentetag, st.st_mtime):
+            return None
+        contentsize, content = string2stream(gitmer.build_project_index(mapping.path))
+        return content, contentsize, "text/xml", st.st_mtime, contentetag
+
+    # package or metadata for project
+    def serve_source_package(self, query, project, name):
+        mapping = gitmer.get_project_mapping(project)
+        if mapping is None or mapping.path is None:
+            return NOTFOUND
+        if name == "_config":
+            contentsize, contentmtime, content = file2stream(mapping.path + "/" + name)
+            return content, contentsize, "text/plain", contentmtime, None
+        elif name == "_meta":
+            st = os.stat(mapping.path + "/_meta")
+            contentetag = self.file_etag(st)
+            if self.not_modified(contentetag, st.st_mtime):
+                return None
+            contentsize, content = string2stream(gitmer.adjust_meta(mapping.path, project))
+            return content, contentsize, "text/xml", st.st_mtime, contentetag
+        elif name == "_pubkey":
+            return NOTFOUND
+        elif name == "_pattern":
+            return NOTFOUND
+        expand = 0
+        rev = None
+        if query.has_key("expand"):
+            expand = int(query["expand"][0])
+        if query.has_key("rev"):
+            rev = query["rev"][0]
+        
+        contentmtime = None
+        contentetag = gitmer.get_package_index_etag(mapping.path, name, rev)
+        if contentetag is not None:
+            contentmtime = gitmer.get_package_mtime(mapping.path)
+            if self.not_modified(contentetag, contentmtime):
+                return None
+        contentsize, content = string2stream(gitmer.get_package_index_supportlink(mapping.path, name, rev, expand))
+        return content, contentsize, "text/xml", contentmtime, contentetag
+
+    def serve_source_file(self, query, project, package, filename):
+        mapping = gitmer.get_project_mapping(project)
+        if mapping is None or mapping.path is None:
+            return NOTFOUND
+        rev = None
+        if query.has_key("rev"):
+                rev = query["rev"][0]
+        if filename == "_meta":
+            result = gitmer.get_package_file_stream(project, mapping.path, package, filename, rev)
+            if result is None:
+                return NOTFOUND
+            contentsize, content = result
+            return content, contentsize, "application/octet-stream", None, None
+        blob = gitmer.get_package_file_blob(mapping.path, package, filename, rev)
+        if blob is None:
+            return NOTFOUND
+        gitpath, sha, contentsize = blob
+        # A blob never changes, its SHA is the perfect ETag
+        contentetag = '"%s"' % sha
+        contentmtime = gitmer.get_package_mtime(mapping.path)
+        if self.not_modified(contentetag, contentmtime):
+            return None
+        result = gitmer.git_open(gitpath, sha, contentsize)
+        if result is None:
+            return NOTFOUND
+        contentsize, content = result
+        return content, contentsize, "application/octet-stream", contentmtime, contentetag
+
+    #/public/build/Mer:Trunk:Base/standard/i586/_repository?view=cache
+    def serve_build(self, query, project, repository, scheduler, binary):
+        mapping = gitmer.get_project_mapping(project)
+        if mapping is None or mapping.binaries is None:
+            repopath = "--UNKNOWNPROJECT/" + repository + "/" + scheduler
+        else:
+            repopath = mapping.binaries + "/" + repository + "/" + scheduler
+        if binary != "_repository":
+            if not isinstance(query.get("binary", None), list):
+                query["binary"] = []
+            query["binary"].append(binary)
+                
+            if not isinstance(query.get("view", None), list):
+                query["view"] = ["names"]
+
+        print repopath
+        print query
+
+        view = query.get("view", [None])[0]
+        if view == "cache" or view == "solvstate":
+            if os.path.isfile(repopath + "/_repository?view=" + view):
+                contentsize, contentmtime, content = file2stream(repopath + "/_repository?view=" + view)
+            else:
+                contentsize, contentmtime, content = file2stream("tools/emptyrepositorycache.cpio")
+            return content, contentsize, "application/octet-stream", contentmtime, None
+        elif view == "cpio":
+            binaries = [os.path.basename(x) + ".rpm" for x in query["binary"]]
+            print binaries
+
+            content = cpio.ArchiveStream(repopath, binaries)
+            print content.size
+            return content, content.size, "application/x-cpio", None, content.etag
+        elif (view == "names" or view == "binaryversions") and not query.has_key("binary"):
+            # The whole list, as mirrorbuild.py asks for it
+            if os.path.isfile(repopath + "/_repository?view=" + view):
+                contentsize, contentmtime, content = file2stream(repopath + "/_repository?view=" + view)
+                return content, contentsize, "text/html", contentmtime, None
+            return NOTFOUND
+        elif view == "names":
+            if os.path.isfile(repopath + "/_repository?view=names"):
+                binarylist = gitmer.get_binarylist(repopath + "/_repository?view=names", "filename")
+                contentsize, content = string2stream(binarylist.lookup(query["binary"]))
+            else:
+                contentsize, content = string2stream("<binarylist />")
+            return content, contentsize, "text/html", None, None
+        elif view == "binaryversions":
+            if os.path.isfile(repopath + "/_repository?view=cache"):
+                binarylist = gitmer.get_binarylist(repopath + "/_repository?view=binaryversions", "name")
+                contentsize, content = string2stream(binarylist.lookup(query["binary"]))
+            else:
+                contentsize, content = string2stream("<binaryversionlist />")
+            return content, contentsize, "text/html", None, None
+        return NOTFOUND
+
     def copyfile(self, source, outputfile):
         """Copy all data between two file objects.
 
@@ -309,12 +701,87 @@ class SimpleHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         -- note however that this the default server uses this
         to copy binary data as well.
 
+        Files on disk, including the members of cpio archives, are
+        handed to sendfile() instead.
+
         """
+        f = source
+        if isinstance(source, RangeStream):
+            f, offset, count = source.stream, source.first, source.remaining
+        elif isinstance(source, file):
+            offset = source.tell()
+            count = os.fstat(source.fileno()).st_size - offset
+        if isinstance(f, file) and count > 0 and self.sendfile(f, offset, count, outputfile):
+            return
+        if isinstance(source, cpio.ArchiveStream):
+            source.copyto(outputfile, self.sendfile)
+            return
         shutil.copyfileobj(source, outputfile)
 
+    def sendfile(self, f, offset, count, outputfile):
+        """Send count bytes of file f from offset without copying them
+        through Python strings.
+
+        Hands buffers over an mmap of the file to the socket itself,
+        as outputfile.write() would make a string of each. Returns
+        False if the file can't be mapped and nothing was sent.
+
+        """
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+            return False
+        try:
+            if offset + count > len(mapped):
+                raise IOError("file shrunk while sending it")
+            outputfile.flush()
+            end = offset + count
+            while offset < end:
+                chunk = min(end - offset, 1024 * 1024)
+                self.connection.sendall(buffer(mapped, offset, chunk))
+                offset = offset + chunk
+        finally:
+            mapped.close()
+        return True
+
 
 class XFSPWebServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
-    pass
+    # Most connections served at the same time, each has a thread. None
+    # for no limit, otherwise new connections beyond it get a 503.
+    max_connections = None
+
+    def __init__(self, server_address, RequestHandlerClass):
+        self.connections = 0
+        self.connectionsLock = threading.Lock()
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, RequestHandlerClass)
+
+    def process_request(self, request, client_address):
+        self.connectionsLock.acquire()
+        try:
+            full = self.max_connections is not None and self.connections >= self.max_connections
+            if not full:
+                self.connections = self.connections + 1
+        finally:
+            self.connectionsLock.release()
+        if full:
+            print "503: too many connections, turning away %s" % (client_address,)
+            try:
+                request.sendall(OVERLOADED % SimpleHTTPRequestHandler.retry_after)
+            except socket.error:
+                pass
+            self.shutdown_request(request)
+            return
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            self.connectionsLock.acquire()
+            try:
+                self.connections = self.connections - 1
+            finally:
+                self.connectionsLock.release()
 
 
 def termhandler(signum, frame):
@@ -325,12 +792,11 @@ def sigusr1handler(signum, frame):
     print 'Got a SIGUSR1 ...'
     for t in threading.enumerate():
         print t.name
+    if isinstance(frame.f_locals.get("httpd"), asyncserver.AsyncHTTPServer):
+        for x in frame.f_locals["httpd"].parked_requests():
+            print "Parked: " + x
 
-if __name__ == "__main__":
-
-    PORT = int(sys.argv[1])
-    httpd = XFSPWebServer(("0.0.0.0", PORT), SimpleHTTPRequestHandler)
-
+def serve(httpd):
     try:
         # Start a thread with the server -- that thread will then start one
         # more thread for each request
@@ -352,5 +818,122 @@ if __name__ == "__main__":
         print "Shutdown requested ..."
         httpd.shutdown()
 
+# Forks the given number of worker processes that serve the same listening
+# socket, so requests are spread over all CPUs. Each worker has its own caches, they all check
+# the files they come from for changes. SIGTERM and SIGUSR1 are passed on
+# to the workers and a worker that dies is replaced.
+class PreforkServer(object):
+    def __init__(self, httpd, workers):
+        self.httpd = httpd
+        self.workers = workers
+        self.pids = set()
+        self.stopping = False
+        if isinstance(httpd, SocketServer.BaseServer):
+            # Only one worker gets each connection, the others must not
+            # wait for it in accept()
+            httpd.socket.setblocking(0)
+
+    def start_worker(self):
+        pid = os.fork()
+        if pid == 0:
+            self.pids.clear()
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+            try:
+                serve(self.httpd)
+            finally:
+                sys.stdout.flush()
+                os._exit(0)
+        self.pids.add(pid)
+
+    def forward(self, signum, frame):
+        if signum == signal.SIGTERM:
+            print 'Got a SIGTERM, stopping workers ...'
+            self.stopping = True
+        for pid in list(self.pids):
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def serve_forever(self):
+        for x in range(self.workers):
+            self.start_worker()
+        signal.signal(signal.SIGTERM, self.forward)
+        signal.signal(signal.SIGUSR1, self.forward)
+        print "Started %d workers: %s" % (len(self.pids), " ".join([str(x) for x in self.pids]))
+        while self.pids:
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                break
+            except KeyboardInterrupt:
+                # The workers got the SIGINT too
+                self.stopping = True
+                continue
+            self.pids.discard(pid)
+            if not self.stopping:
+                print "Worker %d exited with status %d, starting a new one" % (pid, status)
+                time.sleep(1)
+                self.start_worker()
+
+if __name__ == "__main__":
+
+    parser = optparse.OptionParser(usage="%prog PORT [options]")
+    parser.add_option("--lastevents-maxwait", type="int", metavar="SECONDS",
+                      help="answer /public/lastevents after SECONDS even if there are no new events")
+    parser.add_option("--workers", type="int", default=1, metavar="N",
+                      help="serve from N processes sharing the port (default %default)")
+    parser.add_option("--max-connections", type="int", metavar="N",
+                      help="turn new connections away with a 503 while N are open")
+    parser.add_option("--limit", action="append", default=[], metavar="ENDPOINT=N[/QUEUED]",
+                      help="run at most N requests to ENDPOINT (cpio, source or metadata) at a time "
+                           "and let at most QUEUED more wait for their turn, the rest get a 503. "
+                           "May be given for each endpoint (default cpio=4/32, source=16/128, "
+                           "metadata=32/256)")
+    parser.add_option("--idle-timeout", type="int", default=300, metavar="SECONDS",
+                      help="close connections idle for SECONDS, 0 for never (default %default)")
+    parser.add_option("--max-requests", type="int", default=1000, metavar="N",
+                      help="close connections after N requests, 0 for never (default %default)")
+    parser.add_option("--async", action="store_true", dest="asyncmode", default=False,
+                      help="serve all connections from one event loop instead of a thread each")
+    parser.add_option("--async-threads", type="int", default=16, metavar="N",
+                      help="number of threads handling requests with --async (default %default)")
+    parser.add_option("--open-repos", type="int", default=gitmer.repopool.maxidle, metavar="N",
+                      help="keep up to N idle git repositories open between requests (default %default)")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("PORT is required")
+
+    limits = {"cpio": (4, 32), "source": (16, 128), "metadata": (32, 256)}
+    for x in options.limit:
+        try:
+            endpoint, sep, limit = x.partition("=")
+            running, sep, queued = limit.partition("/")
+            limits[endpoint] = (int(running), int(queued or 0))
+        except ValueError:
+            parser.error("bad --limit %s" % x)
+        if endpoint not in ("cpio", "source", "metadata"):
+            parser.error("unknown endpoint in --limit %s" % x)
+
+    PORT = int(args[0])
+    SimpleHTTPRequestHandler.lastevents_maxwait = options.lastevents_maxwait
+    SimpleHTTPRequestHandler.timeout = options.idle_timeout or None
+    SimpleHTTPRequestHandler.max_requests = options.max_requests or None
+    SimpleHTTPRequestHandler.limits = dict([(x, EndpointLimit(*limits[x])) for x in limits])
+    gitmer.repopool.maxidle = options.open_repos
+    if options.asyncmode:
+        httpd = asyncserver.AsyncHTTPServer(("0.0.0.0", PORT), SimpleHTTPRequestHandler, options.async_threads, options.max_connections)
+    else:
+        XFSPWebServer.max_connections = options.max_connections
+        httpd = XFSPWebServer(("0.0.0.0", PORT), SimpleHTTPRequestHandler)
+
+    if options.workers > 1:
+        PreforkServer(httpd, options.workers).serve_forever()
+    else:
+        serve(httpd)
+
     print "Shutdown complete."
     sys.exit(0)
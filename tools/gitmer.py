@@ -1,11 +1,21 @@
-from threading import Thread, Lock
+from threading import Thread, Lock, RLock, Condition
+from collections import namedtuple, OrderedDict
 import git
 import hashlib
-import csv, os
+import csv, os, time
+import bisect
+import itertools
+import multiprocessing
+import fcntl
+import select
+import errno
+import sqlite3
 import xml.dom.minidom
+import xml.etree.cElementTree as ElementTree
 from subprocess import *
 from xml.dom.minidom import getDOMImplementation
 import shutil
+import tempfile
 try:
     from cStringIO import StringIO
 except ImportError:
@@ -26,18 +36,404 @@ def synchronized(lock):
         return newFunction
     return wrap
 
+# Thread safe dictionary that forgets the least recently used entries once
+# it holds more than maxsize of them
+class LRUCache(object):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value
+            return value
+        finally:
+            self.lock.release()
+
+    def put(self, key, value):
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.lock.release()
+
+# Rendered package directory listings, see get_package_index
+packageindexcache = LRUCache(1024)
+
+# Changes whenever packs are added or removed, eg. by a fetch or gc in
+# post_merge. A Repo only reads the list of packs when it is opened.
+def get_pack_signature(objectsdir):
+     signature = []
+     for x in ("pack", "info/packs"):
+         try:
+             signature.append(os.stat(os.path.join(objectsdir, x)).st_mtime)
+         except OSError:
+             signature.append(None)
+     return tuple(signature)
+
+# A git.Repo taken from a RepoPool, with the signature of its packs when it
+# was opened
+class OpenRepo(object):
+    def __init__(self, gitpath):
+        self.gitpath = gitpath
+        self.repo = git.Repo(gitpath, odbt=git.GitDB)
+        # Taken before any object is read, so packs added meanwhile are not missed
+        self.signature = get_pack_signature(self.repo.odb.root_path())
+        self.lastused = None
+
+    def current(self):
+        return get_pack_signature(self.repo.odb.root_path()) == self.signature
+
+    # Not repo.close(), that also collects gitdb's memory map manager
+    # which every Repo in every thread shares
+    def close(self):
+        self.repo.git.clear_cache()
+
+# Pool of open git.Repos shared by all threads. gitdb's pack databases
+# can't be read from two threads at once, so a Repo is used by one thread
+# at a time: acquire() hands out an idle one or opens a new one, release()
+# gives it back. Reusing Repos keeps their pack indexes and gitdb caches
+# warm between requests. At most maxidle are kept open while idle, the
+# least recently used are closed first, and Repos whose packs changed since
+# they were opened are closed instead of being handed out.
+class RepoPool(object):
+    def __init__(self, maxidle=128):
+        self.maxidle = maxidle
+        self.lock = Lock()
+        # gitpath -> idle OpenRepos, most recently used last
+        self.idle = {}
+        # Idle OpenRepos in all of them
+        self.count = 0
+
+    def _discard(self, openrepo):
+        self.idle[openrepo.gitpath].remove(openrepo)
+        if not self.idle[openrepo.gitpath]:
+            del self.idle[openrepo.gitpath]
+        self.count = self.count - 1
+        openrepo.close()
+
+    def acquire(self, gitpath):
+        gitpath = os.path.normpath(gitpath)
+        while True:
+            self.lock.acquire()
+            try:
+                if not self.idle.get(gitpath):
+                    break
+                openrepo = self.idle[gitpath][-1]
+                if openrepo.current():
+                    self.idle[gitpath].pop()
+                    self.count = self.count - 1
+                    return openrepo
+                self._discard(openrepo)
+            finally:
+                self.lock.release()
+        return OpenRepo(gitpath)
+
+    def release(self, openrepo):
+        self.lock.acquire()
+        try:
+            openrepo.lastused = time.time()
+            self.idle.setdefault(openrepo.gitpath, []).append(openrepo)
+            self.count = self.count + 1
+            while self.count > self.maxidle:
+                oldest = None
+                for openrepos in self.idle.values():
+                    if oldest is None or openrepos[0].lastused < oldest.lastused:
+                        oldest = openrepos[0]
+                self._discard(oldest)
+        finally:
+            self.lock.release()
+
+repopool = RepoPool()
+
+# A file in a commit's tree, read while the Repo was held
+TreeEntry = namedtuple("TreeEntry", "name hexsha size")
+
+# The TreeEntries of commit in the repo at gitpath
+def get_tree_entries(gitpath, commit):
+     openrepo = repopool.acquire(gitpath)
+     try:
+         return [TreeEntry(x.name, x.hexsha, x.size) for x in openrepo.repo.tree(commit)]
+     finally:
+         repopool.release(openrepo)
+
+MAPPINGSCACHE = "packages-git/mappingscache.xml"
+# Same mappings in sqlite, used instead of the XML when it exists
+MAPPINGSDB = "packages-git/mappingscache.db"
+
+# A file of a mapped commit. sha and size of its blob are None in caches
+# written before they were recorded.
+MapEntry = namedtuple("MapEntry", "name md5 sha size")
+
+class MapRecord(object):
+    __slots__ = ("branch", "commit", "rev", "srcmd5", "entries", "mtime")
+
+    # entries is a tuple of MapEntries sorted by name, mtime the commit's
+    # committed_date or None if not recorded
+    def __init__(self, branch, commit, rev, srcmd5, entries, mtime=None):
+        self.branch = branch
+        self.commit = commit
+        self.rev = rev
+        self.srcmd5 = srcmd5
+        self.entries = entries
+        self.mtime = mtime
+
+    # Whether listings and files can be served from the map alone
+    def complete(self):
+        if self.mtime is None:
+            return False
+        for x in self.entries:
+            if x.sha is None:
+                return False
+        return True
+
+class RepoMappings(object):
+    __slots__ = ("branches", "lookups", "commits")
+
+    def __init__(self):
+        # branch -> list of maps in document order, ie. newest commit first
+        self.branches = OrderedDict()
+        # branch -> commit, srcmd5 or rev -> first map in document order
+        self.lookups = {}
+        # commit -> first map on any branch
+        self.commits = {}
+
+    def add(self, record):
+        self.branches.setdefault(record.branch, []).append(record)
+        lookup = self.lookups.setdefault(record.branch, {})
+        lookup.setdefault(record.commit, record)
+        lookup.setdefault(record.srcmd5, record)
+        lookup.setdefault(record.rev, record)
+        self.commits.setdefault(record.commit, record)
+
+# mappingscache.xml loaded into dictionaries: repo path -> RepoMappings
+class MappingsCache(object):
+    def __init__(self, filename):
+        self.mtime = os.stat(filename).st_mtime
+        self.repos = OrderedDict()
+        # Entries repeat across most commits of a repo, share one object
+        # for each of them
+        strings = {}
+        repo = None
+        entries = []
+        for event, elem in ElementTree.iterparse(filename, events=("start", "end")):
+            if event == "start":
+                if elem.tag == "repo":
+                    repo = self.repos.setdefault(elem.get("path"), RepoMappings())
+                continue
+            if elem.tag == "entry":
+                size = elem.get("size")
+                if size is not None:
+                    size = int(size)
+                entry = MapEntry(elem.get("name"), elem.get("md5"), elem.get("sha"), size)
+                entries.append(strings.setdefault(entry, entry))
+            elif elem.tag == "map":
+                branch = strings.setdefault(elem.get("branch"), elem.get("branch"))
+                mtime = elem.get("mtime")
+                if mtime is not None:
+                    mtime = int(mtime)
+                repo.add(MapRecord(branch, elem.get("commit"), elem.get("rev"), elem.get("srcmd5"), tuple(sorted(entries)), mtime))
+                entries = []
+                elem.clear()
+            elif elem.tag == "repo":
+                elem.clear()
+
+    # Map on branch whose commit, srcmd5 or rev is key
+    def lookup(self, gitpath, branch, key):
+        repo = self.repos.get(gitpath)
+        if repo is None or not repo.lookups.has_key(branch):
+            return None
+        return repo.lookups[branch].get(key)
+
+    def lookup_commit(self, gitpath, commit):
+        repo = self.repos.get(gitpath)
+        if repo is None:
+            return None
+        return repo.commits.get(commit)
+
+    def repo_paths(self):
+        return self.repos.keys()
+
+    def get_repo(self, gitpath):
+        return self.repos.get(gitpath)
+
+MAPPINGSDB_SCHEMA = """
+CREATE TABLE repos (id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE);
+CREATE TABLE maps (id INTEGER PRIMARY KEY, repo INTEGER NOT NULL, branch TEXT NOT NULL,
+                   commitsha TEXT NOT NULL, rev TEXT NOT NULL, srcmd5 TEXT NOT NULL, mtime INTEGER);
+CREATE TABLE entries (map INTEGER NOT NULL, name TEXT NOT NULL, md5 TEXT NOT NULL,
+                      sha TEXT, size INTEGER);
+CREATE INDEX maps_commit ON maps (repo, branch, commitsha);
+CREATE INDEX maps_srcmd5 ON maps (repo, branch, srcmd5);
+CREATE INDEX maps_rev ON maps (repo, branch, rev);
+CREATE INDEX maps_anybranch ON maps (repo, commitsha);
+CREATE INDEX entries_map ON entries (map);
+PRAGMA user_version = 1;
+"""
+# Bumped with every change to MAPPINGSDB_SCHEMA
+MAPPINGSDB_VERSION = 1
+
+# The mappings in sqlite, queried as needed instead of being loaded up
+# front. Same interface as MappingsCache; map ids follow document order,
+# so the lowest matching id is the map MappingsCache would find.
+class MappingsDB(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.mtime = os.stat(filename).st_mtime
+        self.lock = Lock()
+        self.pid = None
+        self.records = LRUCache(4096)
+
+    def query(self, sql, args=()):
+        self.lock.acquire()
+        try:
+            # A connection can't be shared with processes forked off later
+            if self.pid != os.getpid():
+                self.db = sqlite3.connect(self.filename, check_same_thread=False)
+                self.db.text_factory = str
+                self.pid = os.getpid()
+            return self.db.execute(sql, args).fetchall()
+        finally:
+            self.lock.release()
+
+    # Closes the connection; a thread still holding on to this instance
+    # gets a new one on its next query
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.pid == os.getpid():
+                self.db.close()
+            self.db = None
+            self.pid = None
+        finally:
+            self.lock.release()
+
+    # The first map matching any of the conditions in wheres. Each one is
+    # its own SELECT so that each can use an index, an OR of them can't.
+    def record(self, wheres, args):
+        cached = self.records.get((wheres, args))
+        if cached is not None:
+            return cached
+        rows = self.query(" UNION ALL ".join(["SELECT maps.id AS id, branch, commitsha, rev, srcmd5, mtime FROM maps"
+                                              " JOIN repos ON repos.id = maps.repo WHERE " + x for x in wheres]) +
+                          " ORDER BY id LIMIT 1", args)
+        if not rows:
+            return None
+        mapid, branch, commit, rev, srcmd5, mtime = rows[0]
+        entries = self.query("SELECT name, md5, sha, size FROM entries WHERE map = ?", (mapid,))
+        record = MapRecord(branch, commit, rev, srcmd5, tuple(sorted([MapEntry(*x) for x in entries])), mtime)
+        self.records.put((wheres, args), record)
+        return record
+
+    def lookup(self, gitpath, branch, key):
+        return self.record(("path = ? AND branch = ? AND commitsha = ?",
+                            "path = ? AND branch = ? AND srcmd5 = ?",
+                            "path = ? AND branch = ? AND rev = ?"),
+                           (gitpath, branch, key) * 3)
+
+    def lookup_commit(self, gitpath, commit):
+        return self.record(("path = ? AND commitsha = ?",), (gitpath, commit))
+
+    def repo_paths(self):
+        return [x[0] for x in self.query("SELECT path FROM repos ORDER BY id")]
+
+    # All maps of a repo as RepoMappings, None if it has none
+    def get_repo(self, gitpath):
+        rows = self.query("SELECT maps.id, branch, commitsha, rev, srcmd5, mtime FROM maps JOIN repos ON repos.id = maps.repo"
+                          " WHERE path = ? ORDER BY maps.id", (gitpath,))
+        if not rows:
+            return None
+        entries = {}
+        strings = {}
+        for row in self.query("SELECT map, name, md5, sha, size FROM entries JOIN maps ON maps.id = entries.map"
+                              " JOIN repos ON repos.id = maps.repo WHERE path = ?", (gitpath,)):
+            entry = MapEntry(*row[1:])
+            entries.setdefault(row[0], []).append(strings.setdefault(entry, entry))
+        repo = RepoMappings()
+        for mapid, branch, commit, rev, srcmd5, mtime in rows:
+            repo.add(MapRecord(branch, commit, rev, srcmd5, tuple(sorted(entries.get(mapid, []))), mtime))
+        return repo
+
+# MappingsDB or MappingsCache for filename, depending on its extension
+def open_mappings(filename):
+     if filename.endswith(".db"):
+         return MappingsDB(filename)
+     return MappingsCache(filename)
+
 @synchronized(myLock)
 def get_mappingscache():
-     if not hasattr(get_mappingscache, "mcache"):
-        get_mappingscache.mcache = xml.dom.minidom.parse("packages-git/mappingscache.xml")
-        get_mappingscache.mcachetime = os.stat("packages-git/mappingscache.xml").st_mtime
-     stat = os.stat("packages-git/mappingscache.xml")
-     if get_mappingscache.mcachetime != stat.st_mtime:
-         print "mappings cache was updated, reloading.."
-         get_mappingscache.mcache = xml.dom.minidom.parse("packages-git/mappingscache.xml")
-         get_mappingscache.mcachetime = os.stat("packages-git/mappingscache.xml").st_mtime   
+     if os.path.isfile(MAPPINGSDB):
+         filename = MAPPINGSDB
+     else:
+         filename = MAPPINGSCACHE
+     mcache = getattr(get_mappingscache, "mcache", None)
+     stat = os.stat(filename)
+     if mcache is None or get_mappingscache.filename != filename or mcache.mtime != stat.st_mtime:
+         if mcache is not None:
+             print "mappings cache was updated, reloading.."
+             packageindexcache.clear()
+             if isinstance(mcache, MappingsDB):
+                 mcache.close()
+         get_mappingscache.mcache = open_mappings(filename)
+         get_mappingscache.filename = filename
      return get_mappingscache.mcache
 
+# Blob SHA -> (md5, size) store, shared by every repo and commit in
+# packages-git/ so each blob only has to be read and hashed once
+BLOBSTORE = "packages-git/blobhashes.db"
+blobstoreLock = RLock()
+
+@synchronized(blobstoreLock)
+def get_blobstore():
+     if not hasattr(get_blobstore, "db"):
+        db = sqlite3.connect(BLOBSTORE, timeout=60, check_same_thread=False)
+        db.execute("CREATE TABLE IF NOT EXISTS blobs (sha TEXT PRIMARY KEY, md5 TEXT NOT NULL, size INTEGER NOT NULL)")
+        db.commit()
+        get_blobstore.db = db
+     return get_blobstore.db
+
+@synchronized(blobstoreLock)
+def lookup_blob(sha):
+     row = get_blobstore().execute("SELECT md5, size FROM blobs WHERE sha = ?", (sha,)).fetchone()
+     if row is None:
+         return None
+     return str(row[0]), row[1]
+
+@synchronized(blobstoreLock)
+def store_blob(sha, md5, size, commit=True):
+     get_blobstore().execute("INSERT OR REPLACE INTO blobs (sha, md5, size) VALUES (?, ?, ?)", (sha, md5, size))
+     if commit:
+         get_blobstore().commit()
+
+@synchronized(blobstoreLock)
+def flush_blobstore():
+     get_blobstore().commit()
+
+def get_blob_md5(gitpath, sha, size=None, commit=True):
+     known = lookup_blob(sha)
+     if known is not None:
+         return known[0]
+     st = git_cat(gitpath, sha)
+     if size is not None:
+         assert len(st) == size
+     md5 = hashlib.md5(st).hexdigest()
+     store_blob(sha, md5, len(st), commit=commit)
+     return md5
+
 #def get_mappingscache(filename):
 #    if mcache.has_key(filename):
 #       stat = os.stat(filename)
@@ -48,124 +444,202 @@ def get_mappingscache():
 #    mcache[filename] = (stat.st_mtime, doc)
 #    return doc
 
-def adjust_meta(projectpath, projectname):
+# Project _meta files renamed for the project they are served as
+metacache = LRUCache(256)
+
+# Returns the mtime of projectpath/_meta and the _meta for projectname
+def get_project_meta(projectpath, projectname):
+        mtime = os.stat(projectpath + "/_meta").st_mtime
+        cachekey = (projectpath, projectname, mtime)
+        cached = metacache.get(cachekey)
+        if cached is not None:
+            return mtime, cached
         meta = xml.dom.minidom.parse(projectpath + "/_meta")
         for x in meta.getElementsByTagName("project"):
             x.setAttribute("name", projectname)
-        return meta.childNodes[0].toxml(encoding="us-ascii")
+        output = meta.childNodes[0].toxml(encoding="us-ascii")
+        metacache.put(cachekey, output)
+        return mtime, output
 
-def build_project_index(projectpath):
-        impl = getDOMImplementation()
-        indexdoc = impl.createDocument(None, "directory", None)
+def adjust_meta(projectpath, projectname):
+        return get_project_meta(projectpath, projectname)[1]
+
+# mappings.xml as a table from OBS project name to where its sources and
+# binaries are. Attributes a <mapping> does not have are None and the
+# first <mapping> of a project wins.
+MAPPINGS = "mappings.xml"
+
+ProjectMapping = namedtuple("ProjectMapping", "path binaries reponame")
+
+class ProjectMappings(object):
+    def __init__(self, filename):
+        self.mtime = os.stat(filename).st_mtime
+        self.projects = {}
+        doc = xml.dom.minidom.parse(filename)
+        for x in doc.getElementsByTagName("mapping"):
+            mapping = ProjectMapping(*[x.getAttribute(y) or None for y in ProjectMapping._fields])
+            self.projects.setdefault(x.getAttribute("project"), mapping)
 
-        packagesdoc = xml.dom.minidom.parse(projectpath + "/packages.xml")            
+projectmappingsLock = Lock()
+
+@synchronized(projectmappingsLock)
+def get_project_mappings():
+     mappings = getattr(get_project_mappings, "mappings", None)
+     if mappings is None or mappings.mtime != os.stat(MAPPINGS).st_mtime:
+        if mappings is not None:
+            print MAPPINGS + " was updated, reloading.."
+        mappings = ProjectMappings(MAPPINGS)
+        get_project_mappings.mappings = mappings
+     return mappings
+
+# The ProjectMapping of an OBS project, None if it is not mapped
+def get_project_mapping(projectname):
+        return get_project_mappings().projects.get(projectname)
+
+# Parsed packages.xml of a project. Links are resolved when the file is
+# loaded so every lookup is a single dictionary hit.
+ProjectPackage = namedtuple("ProjectPackage", "git commit followbranch vrev")
+
+class Project(object):
+    def __init__(self, projectpath):
+        self.path = projectpath
+        self.mtime = os.stat(projectpath + "/packages.xml").st_mtime
+        packagesdoc = xml.dom.minidom.parse(projectpath + "/packages.xml")
+        self.disablei586 = packagesdoc.childNodes[0].attributes.has_key("disablei586")
+        # Names as listed in the project index, packages first and then links
+        self.names = []
+        self.index = None
+        self.packages = {}
+        self.links = {}
+        # Names of packages and links with enablei586, whether or not the
+        # link can be resolved
+        self.enabled = set()
         for x in packagesdoc.getElementsByTagName("package"):
-            entryelm = indexdoc.createElement("entry")
-            entryelm.setAttribute("name", x.attributes["name"].value)
-            indexdoc.childNodes[0].appendChild(entryelm)
+            name = x.attributes["name"].value
+            self.names.append(name)
+            if x.attributes.has_key("enablei586"):
+                self.enabled.add(name)
+            if not self.packages.has_key(name):
+                self.packages[name] = ProjectPackage(x.getAttribute("git"), x.getAttribute("commit"), x.getAttribute("followbranch"), x.getAttribute("vrev"))
         for x in packagesdoc.getElementsByTagName("link"):
-            entryelm = indexdoc.createElement("entry")
-            entryelm.setAttribute("name", x.attributes["to"].value)
-            indexdoc.childNodes[0].appendChild(entryelm)
-	return indexdoc.childNodes[0].toprettyxml(encoding="us-ascii")
+            name = x.attributes["to"].value
+            self.names.append(name)
+            if x.attributes.has_key("enablei586"):
+                self.enabled.add(name)
+            if not self.links.has_key(name):
+                self.links[name] = x.attributes["from"].value
+
+        for name in self.links.keys():
+            if self.packages.has_key(name):
+                continue
+            target = self.links[name]
+            seen = set([name])
+            while not self.packages.has_key(target) and self.links.has_key(target) and not target in seen:
+                seen.add(target)
+                target = self.links[target]
+            if self.packages.has_key(target):
+                self.packages[name] = self.packages[target]
+
+    def get_package(self, packagename):
+        return self.packages.get(packagename)
+
+    # The <directory> listing of the project, rendered on first use
+    def get_index(self):
+        if self.index is None:
+            impl = getDOMImplementation()
+            indexdoc = impl.createDocument(None, "directory", None)
+            for name in self.names:
+                entryelm = indexdoc.createElement("entry")
+                entryelm.setAttribute("name", name)
+                indexdoc.childNodes[0].appendChild(entryelm)
+            self.index = indexdoc.childNodes[0].toprettyxml(encoding="us-ascii")
+        return self.index
+
+projectsLock = Lock()
+
+@synchronized(projectsLock)
+def get_project(projectpath):
+     if not hasattr(get_project, "projects"):
+        get_project.projects = {}
+     project = get_project.projects.get(projectpath)
+     if project is None or project.mtime != os.stat(projectpath + "/packages.xml").st_mtime:
+        if project is not None:
+            print projectpath + "/packages.xml was updated, reloading.."
+            packageindexcache.clear()
+        project = Project(projectpath)
+        get_project.projects[projectpath] = project
+     return project
+
+def build_project_index(projectpath):
+        return get_project(projectpath).get_index()
 
 # Generate index XML
 #print build_project_index("Base")
 
-# Returns commit, rev, md5sum, tree
+# Returns the MapRecord of the package's branch matching commit, srcmd5 or rev
+def get_package_map(projectpath, packagename, commit):
+        package = get_project(projectpath).get_package(packagename)
+        if package is None:
+            return None
+        return get_mappingscache().lookup(package.git, package.followbranch, commit)
+
+# Returns commit, rev, md5sum, TreeEntries, git path
 def get_package_tree_from_commit_or_rev(projectpath, packagename, commit):
-        packagesdoc = xml.dom.minidom.parse(projectpath + "/packages.xml")       
-        for x in packagesdoc.getElementsByTagName("package"):
-            if x.attributes["name"].value == packagename:
-                followbranch = x.attributes["followbranch"].value
-                for mappingsdoc in get_mappingscache().getElementsByTagName("repo"):
-                 if mappingsdoc.attributes["path"].value == x.attributes["git"].value:
-                   for y in mappingsdoc.getElementsByTagName("map"):
-                    if y.attributes["branch"].value != followbranch:
-                        continue
-                    if y.attributes["commit"].value == commit or y.attributes["srcmd5"].value == commit or y.attributes["rev"].value == commit:
-                            repo = git.Repo(x.attributes["git"].value, odbt=git.GitDB)
-                            return y.attributes["commit"].value, y.attributes["rev"].value, y.attributes["srcmd5"].value, repo.tree(y.attributes["commit"].value), x.attributes["git"].value
-        for x in packagesdoc.getElementsByTagName("link"):
-            if x.attributes["to"].value == packagename:
-                return get_package_tree_from_commit_or_rev(projectpath, x.attributes["from"].value, commit)
-        
-        return None                    
+        package = get_project(projectpath).get_package(packagename)
+        if package is None:
+            return None
+        y = get_package_map(projectpath, packagename, commit)
+        if y is None:
+            return None
+        return y.commit, y.rev, y.srcmd5, get_tree_entries(package.git, y.commit), package.git
 
 def get_package_tree_and_commit(projectpath, packagename):
-        packagesdoc = xml.dom.minidom.parse(projectpath + "/packages.xml")            
-        for x in packagesdoc.getElementsByTagName("package"):
-            if x.attributes["name"].value == packagename:
-                repo = git.Repo(x.attributes["git"].value, odbt=git.GitDB)
-                return x.attributes["commit"].value, repo.tree(x.attributes["commit"].value)
-        for x in packagesdoc.getElementsByTagName("link"):
-            if x.attributes["to"].value == packagename:
-                return get_package_tree_and_commit(projectpath, x.attributes["from"].value)
-        return None
+        package = get_project(projectpath).get_package(packagename)
+        if package is None:
+            return None
+        return package.commit, get_tree_entries(package.git, package.commit)
 
 def get_package_tree_for_commit_or_rev(projectpath, packagename, revorcommit):
-        packagesdoc = xml.dom.minidom.parse(projectpath + "/packages.xml")            
-        for x in packagesdoc.getElementsByTagName("package"):
-            if x.attributes["name"].value == packagename:
-                repo = git.Repo(x.attributes["git"].value, odbt=git.GitDB)
-                return x.attributes["commit"].value, repo.tree(x.attributes["commit"].value)
-        for x in packagesdoc.getElementsByTagName("link"):
-            if x.attributes["to"].value == packagename:
-                return get_package_tree_for_commit_or_rev(projectpath, x.attributes["from"].value, revorcommit)
-        return None
-        
+        return get_package_tree_and_commit(projectpath, packagename)
 
 def get_package_commit_mtime_vrev(projectpath, packagename):
-        packagesdoc = xml.dom.minidom.parse(projectpath + "/packages.xml")            
-        for x in packagesdoc.getElementsByTagName("package"):
-            if x.attributes["name"].value == packagename:
-                repo = git.Repo(x.attributes["git"].value, odbt=git.GitDB)
-                return repo.commit(x.attributes["commit"].value).committed_date, x.attributes["vrev"].value
-        for x in packagesdoc.getElementsByTagName("link"):
-            if x.attributes["to"].value == packagename:
-                return get_package_commit_mtime_vrev(projectpath, x.attributes["from"].value)
-        return None
-        
+        package = get_project(projectpath).get_package(packagename)
+        if package is None:
+            return None
+        y = get_mappingscache().lookup(package.git, package.followbranch, package.commit)
+        if y is not None and y.mtime is not None:
+            return y.mtime, package.vrev
+        openrepo = repopool.acquire(package.git)
+        try:
+            return openrepo.repo.commit(package.commit).committed_date, package.vrev
+        finally:
+            repopool.release(openrepo)
 
 def get_entries_from_commit(projectpath, packagename, commit):
-        packagesdoc = xml.dom.minidom.parse(projectpath + "/packages.xml")            
-        for x in packagesdoc.getElementsByTagName("package"):
-            if x.attributes["name"].value == packagename:
-                
-                for mappingsdoc in get_mappingscache().getElementsByTagName("repo"):
-                 if mappingsdoc.attributes["path"].value == x.attributes["git"].value:
-                  for y in mappingsdoc.getElementsByTagName("map"):
-                    if y.attributes["commit"].value == commit:
-                        entries = {}
-                        for z in y.getElementsByTagName("entry"):
-                            entries[z.attributes["name"].value] = z.attributes["md5"].value
-                        return entries
-        for x in packagesdoc.getElementsByTagName("link"):
-            if x.attributes["to"].value == packagename:
-                return get_entries_from_commit(projectpath, x.attributes["from"].value, commit)
-        return None       
+        package = get_project(projectpath).get_package(packagename)
+        if package is None:
+            return None
+        y = get_mappingscache().lookup_commit(package.git, commit)
+        if y is None:
+            return None
+        return dict([(x.name, x.md5) for x in y.entries])
 
 def get_latest_commit(projectpath, packagename):
-        packagesdoc = xml.dom.minidom.parse(projectpath + "/packages.xml")            
-        for x in packagesdoc.getElementsByTagName("package"):
-            if x.attributes["name"].value == packagename:
-                        return x.attributes["commit"].value
-        for x in packagesdoc.getElementsByTagName("link"):
-            if x.attributes["to"].value == packagename:
-                return get_latest_commit(projectpath, x.attributes["from"].value)
-        return None       
+        package = get_project(projectpath).get_package(packagename)
+        if package is None:
+            return None
+        return package.commit
 
 def get_package_link(projectpath, packagename):
-        packagesdoc = xml.dom.minidom.parse(projectpath + "/packages.xml")            
-        for x in packagesdoc.getElementsByTagName("link"):
-            if x.attributes["to"].value == packagename:
-                return x.attributes["to"].value
+        if get_project(projectpath).links.has_key(packagename):
+            return packagename
         return None
 
 def get_package_index_supportlink(projectpath, packagename, getrev, expand):
         return get_package_index(projectpath, packagename, getrev=getrev)    
 
-def get_package_index(projectpath, packagename, getrev=None):
+# Turns the rev asked for by OBS into a commit, srcmd5 or rev to look up
+def resolve_getrev(projectpath, packagename, getrev):
         if getrev is None:
             getrev = "latest"
         if getrev == "upload":
@@ -174,91 +648,383 @@ def get_package_index(projectpath, packagename, getrev=None):
             getrev = "latest"
         if getrev == "latest":
             getrev = get_latest_commit(projectpath, packagename)
-        
+        return getrev
+
+# Package listings and files only change when packages.xml or the mappings
+# cache do, so the newer of the two serves as their modification time
+def get_package_mtime(projectpath):
+        return max(get_project(projectpath).mtime, get_mappingscache().mtime)
+
+# Returns an ETag for the listing get_package_index would return, or None
+def get_package_index_etag(projectpath, packagename, getrev=None):
+        package = get_project(projectpath).get_package(packagename)
+        if package is None:
+            return None
+        y = get_package_map(projectpath, packagename, resolve_getrev(projectpath, packagename, getrev))
+        if y is None:
+            return None
+        # vrev and the mtime of the latest commit are part of the listing too
+        return '"%s-%s"' % (y.srcmd5, hashlib.md5(" ".join([y.commit, package.commit, package.vrev])).hexdigest()[:16])
+
+def get_package_index(projectpath, packagename, getrev=None):
+        getrev = resolve_getrev(projectpath, packagename, getrev)
+
+        # The listing of a given commit only changes with packages.xml
+        # (vrev, mtime) or the mappings cache (md5s), so it is rendered once
+        # per commit and those files' versions
+        y = get_package_map(projectpath, packagename, getrev)
+        cachekey = None
+        if y is not None:
+            cachekey = (projectpath, get_project(projectpath).mtime, get_mappingscache().mtime, packagename, y.commit)
+            cached = packageindexcache.get(cachekey)
+            if cached is not None:
+                return cached
+
         impl = getDOMImplementation()
         indexdoc = impl.createDocument(None, "directory", None)
         indexdoc.childNodes[0].setAttribute("name", packagename)
-          
-        commit, rev, srcmd5, tree, git = get_package_tree_from_commit_or_rev(projectpath, packagename, getrev)
+
+        # (name, size, md5) of the files, straight from the mappings cache
+        # if it has them all, from the git tree otherwise
+        if y is not None and y.complete():
+            rev, srcmd5 = y.rev, y.srcmd5
+            files = [(x.name, x.size, x.md5) for x in y.entries]
+        else:
+            commit, rev, srcmd5, tree, git = get_package_tree_from_commit_or_rev(projectpath, packagename, getrev)
+            entrymd5s = get_entries_from_commit(projectpath, packagename, commit)
+            files = []
+            for entry in tree:
+                if entry.name == "_meta" or entry.name == "_attribute":
+                    continue
+                if entrymd5s is not None and entrymd5s.has_key(entry.name):
+                    md5 = entrymd5s[entry.name]
+                else:
+                    md5 = get_blob_md5(git, entry.hexsha, size=entry.size)
+                files.append((entry.name, entry.size, md5))
         indexdoc.childNodes[0].setAttribute("srcmd5", srcmd5)
 
         mtime, vrev = get_package_commit_mtime_vrev(projectpath, packagename)
-        entrymd5s = get_entries_from_commit(projectpath, packagename, commit)
                 
 #        if projectpath == "obs-projects/Core-armv7l":
 #          indexdoc.childNodes[0].setAttribute("rev", str(int(rev) + 1))
 #        else:
         indexdoc.childNodes[0].setAttribute("rev", rev)
         indexdoc.childNodes[0].setAttribute("vrev", vrev)
-        for entry in tree:
-            if entry.name == "_meta" or entry.name == "_attribute":
-                continue
+        for name, size, md5 in files:
             entryelm = indexdoc.createElement("entry")
-            entryelm.setAttribute("name", entry.name)
-            entryelm.setAttribute("size", str(entry.size))
+            entryelm.setAttribute("name", name)
+            entryelm.setAttribute("size", str(size))
             entryelm.setAttribute("mtime", str(mtime))
-            entryelm.setAttribute("md5", entrymd5s[entry.name])
-                        
+            entryelm.setAttribute("md5", md5)
             indexdoc.childNodes[0].appendChild(entryelm)
-        return indexdoc.childNodes[0].toprettyxml(encoding="us-ascii")        
+        output = indexdoc.childNodes[0].toprettyxml(encoding="us-ascii")
+        if cachekey is not None:
+            packageindexcache.put(cachekey, output)
+        return output
 
 
 def get_package_file_supportlink(projectpath, packagename, filename, getrev, expand):
         return get_package_file(projectpath, packagename, filename, getrev=getrev)    
 
 
+# Returns the names of the packages whose commit changed
 def update_package_xml(packagesfile, package=None):
+        changed = []
         packagesdoc = xml.dom.minidom.parse(packagesfile)            
         for x in packagesdoc.getElementsByTagName("package"):
            if not package is None:
             if x.attributes["name"].value != package:
              continue
-           repo = git.Repo(x.attributes["git"].value, odbt=git.GitDB)
-           newestcommitonbranch = repo.commit(x.attributes["followbranch"].value).hexsha
-           if newestcommitonbranch != x.attributes["commit"].value:
-            print "Package " + x.attributes["name"].value + " changed from " + x.attributes["commit"].value + " to " + newestcommitonbranch + " in git " + x.attributes["git"].value + ":"
-            print ""
-            if x.attributes["commit"].value == "":
-              print repo.git.log(newestcommitonbranch)
-            else:
-              print repo.git.log(x.attributes["commit"].value + ".." + newestcommitonbranch)
-            print ""
+           openrepo = repopool.acquire(x.attributes["git"].value)
+           try:
+            repo = openrepo.repo
+            newestcommitonbranch = repo.commit(x.attributes["followbranch"].value).hexsha
+            if newestcommitonbranch != x.attributes["commit"].value:
+             print "Package " + x.attributes["name"].value + " changed from " + x.attributes["commit"].value + " to " + newestcommitonbranch + " in git " + x.attributes["git"].value + ":"
+             print ""
+             if x.attributes["commit"].value == "":
+               print repo.git.log(newestcommitonbranch)
+             else:
+               print repo.git.log(x.attributes["commit"].value + ".." + newestcommitonbranch)
+             print ""
+             changed.append(x.attributes["name"].value)
+           finally:
+            repopool.release(openrepo)
            x.setAttribute("commit", newestcommitonbranch)
         newxml = packagesdoc.toxml(encoding="us-ascii")
         f = open(packagesfile, "wb")
         f.write(newxml)
         f.close()                        
+        return changed
         
+# lastevents with an index of event number -> byte offset of its row. Only
+# the part of the file appended since the last look is read again.
+class EventLog(object):
+    def __init__(self, filename="lastevents"):
+        self.filename = filename
+        self.lock = Lock()
+        self._reset(None)
+
+    def _reset(self, ident):
+        self.ident = ident
+        # Bytes of complete rows indexed so far
+        self.size = 0
+        self.numbers = []
+        self.offsets = []
+        self.ordered = True
+
+    def _refresh(self):
+        f = open(self.filename, 'rb')
+        try:
+            st = os.fstat(f.fileno())
+            if (st.st_dev, st.st_ino) != self.ident or st.st_size < self.size:
+                self._reset((st.st_dev, st.st_ino))
+            if st.st_size == self.size:
+                return
+            f.seek(self.size)
+            data = f.read(st.st_size - self.size)
+        finally:
+            f.close()
+        # Leave a row that is still being written for next time
+        end = data.rfind("\n") + 1
+        offset = 0
+        while offset < end:
+            lineend = data.index("\n", offset) + 1
+            line = data[offset:lineend]
+            if line.strip() == "":
+                offset = lineend
+                continue
+            number = int(line.split("|", 1)[0])
+            if self.numbers and number <= self.numbers[-1]:
+                self.ordered = False
+            self.numbers.append(number)
+            self.offsets.append(self.size + offset)
+            offset = lineend
+        self.size = self.size + end
+
+    def next_event(self):
+        self.lock.acquire()
+        try:
+            self._refresh()
+            if not self.numbers:
+                return 0
+            return self.numbers[-1]
+        finally:
+            self.lock.release()
+
+    # Returns the latest event number and the rows of events after start
+    def events_since(self, start):
+        self.lock.acquire()
+        try:
+            self._refresh()
+            if not self.numbers:
+                return 0, []
+            if self.ordered:
+                first = bisect.bisect_right(self.numbers, start)
+            else:
+                first = 0
+            if first == len(self.numbers):
+                return self.numbers[-1], []
+            f = open(self.filename, 'rb')
+            try:
+                f.seek(self.offsets[first])
+                data = f.read(self.size - self.offsets[first])
+            finally:
+                f.close()
+            last = self.numbers[-1]
+        finally:
+            self.lock.release()
+        rows = []
+        for row in csv.reader(StringIO(data), delimiter='|', quotechar='"'):
+            if int(row[0]) > start:
+                rows.append(row)
+        return last, rows
+
+    # Number of the last row, read from the end of the open file f
+    def _last_number(self, f):
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        data = ""
+        while end > 0:
+            chunk = min(end, 4096)
+            end = end - chunk
+            f.seek(end)
+            data = f.read(chunk) + data
+            lines = data.strip().split("\n")
+            if len(lines) > 1 or (end == 0 and lines[0] != ""):
+                return int(lines[-1].split("|", 1)[0])
+        return 0
+
+    # Appends events, each a (type, x, y, z) tuple, with consecutive
+    # numbers in a single write. The file is locked so concurrent
+    # appenders never hand out the same number twice. Returns the number
+    # of the last event appended.
+    def append(self, events):
+        f = open(self.filename, "a+b")
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            last = self._last_number(f)
+            timestamp = str(int(time.time()))
+            rows = []
+            for event in events:
+                last = last + 1
+                rows.append("|".join([str(last), timestamp] + list(event)) + "\n")
+            f.seek(0, os.SEEK_END)
+            f.write("".join(rows))
+            f.flush()
+            return last
+        finally:
+            f.close()
+
+eventlog = EventLog()
+
 def get_next_event():
-        f = open("lastevents", 'rb')
-        csvReader = csv.reader(f, delimiter='|', quotechar='"')
-        last = 0
-        for row in csvReader:
-            last = int(row[0])
-        f.close()
-        return last 
-           
+        return eventlog.next_event()
+
+def append_events(events):
+        return eventlog.append(events)
+
+# Wakes up everybody waiting for new events as soon as lastevents grows.
+# A single thread watches the file, so waiters do no I/O of their own.
+class EventWatcher(object):
+    def __init__(self, filename="lastevents", interval=1):
+        self.filename = filename
+        self.interval = interval
+        self.lock = Lock()
+        self.thread = None
+        self.stat = None
+        self.next = None
+        self.listeners = []
+        # Write ends of the pipes waiters block on. Condition.wait() with a
+        # timeout polls every few milliseconds, select() on a pipe doesn't.
+        self.waiters = set()
+
+    def _filestat(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            stat = self._filestat()
+            if stat == self.stat:
+                continue
+            next = get_next_event()
+            self.lock.acquire()
+            try:
+                self.stat = stat
+                changed = next != self.next
+                if changed:
+                    self.next = next
+                    for writefd in self.waiters:
+                        try:
+                            os.write(writefd, "x")
+                        except OSError, e:
+                            # A full pipe wakes the waiter up just as well
+                            if e.errno != errno.EAGAIN:
+                                raise
+                listeners = list(self.listeners)
+            finally:
+                self.lock.release()
+            if changed:
+                for listener in listeners:
+                    listener(next)
+
+    def _start(self):
+        if self.thread is None:
+            self.stat = self._filestat()
+            self.next = get_next_event()
+            self.thread = Thread(target=self._run, name="EventWatcher")
+            self.thread.daemon = True
+            self.thread.start()
+
+    # Blocks while start is the latest event; timeout None waits forever.
+    # Returns the number of the latest event.
+    def wait(self, start, timeout=None):
+        if timeout is not None:
+            deadline = time.time() + timeout
+        readfd, writefd = os.pipe()
+        fcntl.fcntl(writefd, fcntl.F_SETFL, fcntl.fcntl(writefd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.lock.acquire()
+        try:
+            self._start()
+            self.waiters.add(writefd)
+        finally:
+            self.lock.release()
+        try:
+            # self.next lags the file by up to interval, so ask the event
+            # log itself; the watcher thread only tells us when to look
+            # again. Being registered first, no wake-up is missed.
+            next = get_next_event()
+            while next == start:
+                if timeout is None:
+                    remaining = None
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                try:
+                    ready = select.select([readfd], [], [], remaining)[0]
+                except select.error, e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    ready = []
+                if ready:
+                    os.read(readfd, 4096)
+                next = get_next_event()
+            return next
+        finally:
+            self.lock.acquire()
+            try:
+                self.waiters.discard(writefd)
+            finally:
+                self.lock.release()
+            os.close(readfd)
+            os.close(writefd)
+
+    # The number of the latest event, without waiting
+    def latest(self):
+        self.lock.acquire()
+        try:
+            self._start()
+        finally:
+            self.lock.release()
+        return get_next_event()
+
+    # Calls listener(next) from the watcher thread whenever there are new
+    # events, for those who can't block in wait()
+    def add_listener(self, listener):
+        self.lock.acquire()
+        try:
+            self._start()
+            self.listeners.append(listener)
+        finally:
+            self.lock.release()
+
+eventwatcher = EventWatcher()
+
 
 def get_events_filtered(start, filters):
-        f = open("lastevents", 'rb')
-        
+        last, rows = eventlog.events_since(start)
+
         impl = getDOMImplementation()
         indexdoc = impl.createDocument(None, "events", None)
-        indexdoc.childNodes[0].setAttribute("next", str(get_next_event()))        
-        
-        csvReader = csv.reader(f, delimiter='|', quotechar='"')
-        for row in csvReader:
-            num = int(row[0])
-            if num <= start:
-                continue
-            is_ok = False
-            for filter in filters:
-                if filter[2] is None:
-                    if filter[0] == row[2] and filter[1] == row[3]:
-                       is_ok = True
-                elif filter[0] == row[2] and filter[1] == row[3] and filter[2] == row[4]:
-                    is_ok = True
-            if is_ok:
+        indexdoc.childNodes[0].setAttribute("next", str(last))
+
+        # (type, project) filters match any name, the others need all three
+        projectfilters = set()
+        namefilters = set()
+        for filter in filters:
+            if filter[2] is None:
+                projectfilters.add((filter[0], filter[1]))
+            else:
+                namefilters.add(filter)
+
+        for row in rows:
+            if (row[2], row[3]) in projectfilters or (row[2], row[3], row[4]) in namefilters:
                 eventelm = indexdoc.createElement("event")
                 eventelm.setAttribute("type", row[2])
                 if row[2] == "package":
@@ -289,12 +1055,57 @@ def get_events_filtered(start, filters):
                     prjelm.appendChild(prjtext)
                     eventelm.appendChild(prjelm)
                 indexdoc.childNodes[0].appendChild(eventelm)                
-        f.close()
 #  XXX add support for project events and repository events
 #        print indexdoc.childNodes[0].toxml(encoding="us-ascii")
         
         return indexdoc.childNodes[0].toxml(encoding="us-ascii")
 
+# A repository's _repository?view=names or view=binaryversions document,
+# split into one serialized <binary> per name (the attribute value without
+# its extension), so answering a query only joins the requested ones.
+# Each fragment keeps the whitespace in front of it; asking for every
+# binary gives back the document as it was.
+class BinaryList(object):
+    def __init__(self, filename, attribute):
+        self.mtime = os.stat(filename).st_mtime
+        root = xml.dom.minidom.parse(filename).documentElement
+        self.empty = root.cloneNode(False).toxml().encode("utf-8")
+        self.head = self.empty[:-2] + ">"
+        self.binaries = {}
+        position = 0
+        space = ""
+        for node in root.childNodes:
+            if node.nodeType == node.ELEMENT_NODE and node.tagName == "binary":
+                name = os.path.splitext(node.getAttribute(attribute))[0]
+                self.binaries.setdefault(name, []).append((position, space + node.toxml().encode("utf-8")))
+                position = position + 1
+                space = ""
+            else:
+                space = space + node.toxml().encode("utf-8")
+        self.tail = space + "</" + root.tagName.encode("utf-8") + ">"
+
+    # XML with the <binary> elements for names, in document order
+    def lookup(self, names):
+        found = []
+        for name in set(names):
+            found.extend(self.binaries.get(name, []))
+        if not found:
+            return self.empty
+        found.sort()
+        return self.head + "".join([x[1] for x in found]) + self.tail
+
+binarylistsLock = Lock()
+
+@synchronized(binarylistsLock)
+def get_binarylist(filename, attribute):
+     if not hasattr(get_binarylist, "lists"):
+        get_binarylist.lists = {}
+     binarylist = get_binarylist.lists.get((filename, attribute))
+     if binarylist is None or binarylist.mtime != os.stat(filename).st_mtime:
+        binarylist = BinaryList(filename, attribute)
+        get_binarylist.lists[(filename, attribute)] = binarylist
+     return binarylist
+
 def file_fix_meta(realproject, packagename, metastr, ifdisable):
     meta = xml.dom.minidom.parseString(metastr)
     for x in meta.getElementsByTagName("package"):
@@ -315,30 +1126,42 @@ def file_fix_meta(realproject, packagename, metastr, ifdisable):
     return len(out), out
 
 def get_if_disable(projectpath, packagename):
-    packagesdoc = xml.dom.minidom.parse(projectpath + "/packages.xml")            
-    if packagesdoc.childNodes[0].attributes.has_key("disablei586"):
-      for x in packagesdoc.getElementsByTagName("package"):
-         if x.attributes["name"].value != packagename:
-           continue
-         if x.attributes.has_key("enablei586"):
-           return False 
-      for x in packagesdoc.getElementsByTagName("link"):
-         if x.attributes["to"].value != packagename:
-          continue
-         if x.attributes.has_key("enablei586"):
-           return False
-      return True
+    project = get_project(projectpath)
+    if project.disablei586:
+      return not packagename in project.enabled
     return False
 
 def get_package_file(realproject, projectpath, packagename, filename, getrev):
-        if getrev is None:
-            getrev = "latest"
-        if getrev == "upload":
-            getrev = "latest"
-        if getrev == "build":
-            getrev = "latest"        
-        if getrev == "latest":
-            getrev = get_latest_commit(projectpath, packagename)
+        result = get_package_file_stream(realproject, projectpath, packagename, filename, getrev)
+        if result is None:
+            return None
+        size, stream = result
+        try:
+            return size, stream.read()
+        finally:
+            stream.close()
+
+# Returns git path, blob SHA and size of a file in the package or None
+def get_package_file_blob(projectpath, packagename, filename, getrev):
+        getrev = resolve_getrev(projectpath, packagename, getrev)
+        # The mappings cache leaves out _meta and _attribute, those always
+        # come from the tree
+        y = get_package_map(projectpath, packagename, getrev)
+        if y is not None and y.complete() and filename != "_meta" and filename != "_attribute":
+            for x in y.entries:
+                if x.name == filename:
+                    return get_project(projectpath).get_package(packagename).git, x.sha, x.size
+            return None
+        commit, rev, srcmd5, tree, git = get_package_tree_from_commit_or_rev(projectpath, packagename, getrev)
+        for entry in tree:
+            if entry.name == filename:
+               return git, entry.hexsha, entry.size
+        return None
+
+# Like get_package_file but returns size and a file like object, so large
+# blobs can be sent on without holding them in memory. Caller must close it.
+def get_package_file_stream(realproject, projectpath, packagename, filename, getrev):
+        getrev = resolve_getrev(projectpath, packagename, getrev)
         impl = getDOMImplementation()
         indexdoc = impl.createDocument(None, "directory", None)
         indexdoc.childNodes[0].setAttribute("name", packagename)
@@ -354,65 +1177,403 @@ def get_package_file(realproject, projectpath, packagename, filename, getrev):
   <url>http://www.merproject.org</url>
 </package>
 """ % (realproject, packagename, packagename)
-           return file_fix_meta(realproject, packagename, fakemeta, ifdisable)
-        commit, rev, srcmd5, tree, git = get_package_tree_from_commit_or_rev(projectpath, packagename, getrev)
-        for entry in tree:
-            if entry.name == filename:
-               return entry.size, git_cat(git, entry.hexsha)
+           size, out = file_fix_meta(realproject, packagename, fakemeta, ifdisable)
+           return size, StringIO(out)
+        blob = get_package_file_blob(projectpath, packagename, filename, getrev)
+        if blob is None:
+            return None
+        return git_open(blob[0], blob[1], blob[2])
+
+# Long running "git cat-file --batch" reader for one repository
+class CatFileProcess(object):
+    def __init__(self, gitpath):
+        self.gitpath = gitpath
+        self.lastused = time.time()
+        self.process = Popen(["git", "--git-dir=" + gitpath, "cat-file", "--batch"], stdin=PIPE, stdout=PIPE)
+
+    # Returns the object size, or None if the object does not exist. The
+    # caller must then read exactly that many bytes followed by finish()
+    def request(self, object):
+        self.process.stdin.write(object + "\n")
+        self.process.stdin.flush()
+        header = self.process.stdout.readline()
+        if header == "":
+            raise IOError("git cat-file exited for " + self.gitpath)
+        header = header.split()
+        if len(header) != 3:
+            return None
+        return int(header[2])
+
+    def read(self, size):
+        return self.process.stdout.read(size)
+
+    def finish(self):
+        self.process.stdout.read(1)
+
+    def alive(self):
+        return self.process.poll() is None
+
+    # A process that is in the middle of writing out an object would block
+    # forever on a full pipe, so those are killed instead
+    def close(self, kill=False):
+        if kill and self.alive():
+            self.process.kill()
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        self.process.wait()
+
+# Raised when no git process became free in time
+class Busy(Exception):
+    pass
+
+# Pool of CatFileProcesses shared by all threads. At most maxprocesses are
+# running at once and idle ones are closed after idletimeout seconds.
+# acquire() gives up with Busy after waiting waittimeout seconds.
+class CatFilePool(object):
+    def __init__(self, maxprocesses=8, idletimeout=300, waittimeout=30):
+        self.maxprocesses = maxprocesses
+        self.idletimeout = idletimeout
+        self.waittimeout = waittimeout
+        self.condition = Condition(Lock())
+        # gitpath -> idle processes, most recently used last
+        self.idle = {}
+        self.count = 0
+
+    def _idle_processes(self):
+        for processes in self.idle.values():
+            for process in processes:
+                yield process
+
+    def _discard(self, process):
+        self.idle[process.gitpath].remove(process)
+        if not self.idle[process.gitpath]:
+            del self.idle[process.gitpath]
+        self.count = self.count - 1
+        process.close()
+
+    def acquire(self, gitpath):
+        self.condition.acquire()
+        try:
+            now = time.time()
+            for process in list(self._idle_processes()):
+                if now - process.lastused > self.idletimeout:
+                    self._discard(process)
+            deadline = now + self.waittimeout
+            while True:
+                if self.idle.get(gitpath):
+                    return self.idle[gitpath].pop()
+                if self.count < self.maxprocesses:
+                    break
+                oldest = None
+                for process in self._idle_processes():
+                    if oldest is None or process.lastused < oldest.lastused:
+                        oldest = process
+                if oldest is not None:
+                    self._discard(oldest)
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Busy("no git cat-file process free for " + gitpath)
+                self.condition.wait(remaining)
+            self.count = self.count + 1
+        finally:
+            self.condition.release()
+        try:
+            return CatFileProcess(gitpath)
+        except:
+            self.condition.acquire()
+            self.count = self.count - 1
+            self.condition.notify()
+            self.condition.release()
+            raise
+
+    # Processes that failed half way through an object are not reusable
+    def release(self, process, reusable=True):
+        reusable = reusable and process.alive()
+        if not reusable:
+            process.close(kill=True)
+        self.condition.acquire()
+        try:
+            if reusable:
+                process.lastused = time.time()
+                self.idle.setdefault(process.gitpath, []).append(process)
+            else:
+                self.count = self.count - 1
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+catfilepool = CatFilePool()
+
+# Reads one blob straight from a pooled CatFileProcess. The process goes
+# back to the pool once the blob has been read completely; closing the
+# stream early throws the process away as it is in the middle of an object.
+class BlobStream(object):
+    def __init__(self, pool, process, size):
+        self.pool = pool
+        self.process = process
+        self.remaining = size
+
+    def read(self, size=-1):
+        if self.process is None:
+            return ""
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.process.read(size)
+        self.remaining = self.remaining - len(data)
+        if len(data) < size:
+            self._release(False)
+            raise IOError("short read from git cat-file")
+        if self.remaining == 0:
+            self.process.finish()
+            self._release(True)
+        return data
+
+    def _release(self, reusable):
+        process = self.process
+        self.process = None
+        self.pool.release(process, reusable)
+
+    def close(self):
+        if self.process is not None:
+            self._release(False)
+
+# A blob read by its own "git cat-file blob", for blobs too large to keep
+# a pooled process busy with while a client downloads them
+class BlobProcessStream(object):
+    def __init__(self, gitpath, object, size):
+        self.process = Popen(["git", "--git-dir=" + gitpath, "cat-file", "blob", object], stdout=PIPE)
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.process.stdout.read(size)
+        self.remaining = self.remaining - len(data)
+        if len(data) < size:
+            raise IOError("short read from git cat-file")
+        return data
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.stdout.close()
+        self.process.wait()
+
+# Blobs up to this size are read in one go and kept in memory, larger ones
+# are streamed from a process of their own or spooled to a temporary file.
+# Either way pooled processes are never held while a client downloads.
+BLOBSTREAM_MINSIZE = 1024 * 1024
+
+# Returns size, file like object or None if object does not exist. size is
+# the blob's size if the caller already knows it.
+def git_open(gitpath, object, size=None):
+    if size is not None and size > BLOBSTREAM_MINSIZE:
+        return size, BlobProcessStream(gitpath, object, size)
+    process = catfilepool.acquire(gitpath)
+    try:
+        size = process.request(object)
+    except:
+        catfilepool.release(process, False)
+        raise
+    if size is None:
+        catfilepool.release(process, True)
         return None
+    stream = BlobStream(catfilepool, process, size)
+    if size <= BLOBSTREAM_MINSIZE:
+        return size, StringIO(stream.read())
+    spool = tempfile.TemporaryFile()
+    try:
+        while stream.remaining > 0:
+            spool.write(stream.read(min(stream.remaining, 1024 * 1024)))
+    except:
+        stream.close()
+        spool.close()
+        raise
+    spool.seek(0)
+    return size, spool
 
 def git_cat(gitpath, object):
-    return Popen(["git", "--git-dir=" + gitpath, "cat-file", "blob", object], stdout=PIPE).communicate()[0]
+    blob = git_open(gitpath, object)
+    if blob is None:
+        return ""
+    size, stream = blob
+    try:
+        return stream.read()
+    finally:
+        stream.close()
 
-def generate_mappings(repos):
+def load_previous_mappings(mappingsfile):
+        if not os.path.isfile(mappingsfile):
+            return None
+        mcache = open_mappings(mappingsfile)
+        # A database of an older layout is made again from scratch
+        if isinstance(mcache, MappingsDB) and mcache.query("PRAGMA user_version")[0][0] != MAPPINGSDB_VERSION:
+            print "%s is of an old version, not reusing it" % mappingsfile
+            return None
+        return mcache
+
+def calculate_srcmd5(entries):
+        meta = ""
+        for x in entries:
+            meta += x.md5
+            meta += "  "
+            meta += x.name
+            meta += "\n"
+        return hashlib.md5(meta).hexdigest()
+
+# Hashes every commit on every branch of the repo at path x for
+# generate_mappings(). oldrepo is its RepoMappings from the last run:
+# branches whose head did not move are copied over as is and commits that
+# were already hashed on any branch are not hashed again. Blob md5s come
+# from the blob store, so only new blobs are read; the store is not
+# written to, those are returned for the caller to add.
+# Returns ([(branch, maps)] in the order of repo.heads, [(sha, md5, size)])
+def map_repo(x, oldrepo):
+        knowncommits = dict(oldrepo.commits)
+        newblobs = {}
+        branches = []
+        repo = git.Repo(x, odbt=git.GitDB)
+        for branch in repo.heads:
+            oldmaps = oldrepo.branches.get(branch.name)
+            # Maps from caches without commit dates and blob SHAs are made
+            # again, which only reads trees as the blob md5s are known
+            if oldmaps and oldmaps[0].commit == branch.commit.hexsha and all(y.complete() for y in oldmaps):
+                branches.append((branch.name, oldmaps))
+                continue
+            maps = []
+            commits = list(repo.iter_commits(branch))
+            toprev = len(commits)
+            for rev, cm in enumerate(commits):
+                known = knowncommits.get(cm.hexsha)
+                if known is not None and known.complete():
+                    srcmd5, entries = known.srcmd5, known.entries
+                else:
+                    entries = []
+                    for entry in cm.tree:
+                        if entry.name == "_meta" or entry.name == "_attribute":
+                            continue
+                        if not newblobs.has_key(entry.hexsha):
+                            known = lookup_blob(entry.hexsha)
+                            if known is not None:
+                                md5 = known[0]
+                            else:
+                                st = git_cat(x, entry.hexsha)
+                                assert len(st) == entry.size
+                                md5 = hashlib.md5(st).hexdigest()
+                                newblobs[entry.hexsha] = (md5, len(st))
+                        else:
+                            md5 = newblobs[entry.hexsha][0]
+                        entries.append(MapEntry(entry.name, md5, entry.hexsha, entry.size))
+                    entries = tuple(sorted(entries))
+                    srcmd5 = calculate_srcmd5(entries)
+                record = MapRecord(branch.name, cm.hexsha, str(toprev-rev), srcmd5, entries, cm.committed_date)
+                knowncommits.setdefault(cm.hexsha, record)
+                maps.append(record)
+            branches.append((branch.name, maps))
+        return branches, [(sha, md5, size) for sha, (md5, size) in newblobs.items()]
+
+# map_repo() for a repo of the previous run handed to generate_mappings(),
+# in a process of its pool
+def map_repo_previous(x):
+        oldrepo = None
+        if generate_mappings.previous is not None:
+            oldrepo = generate_mappings.previous.get_repo(x)
+        if oldrepo is None:
+            oldrepo = RepoMappings()
+        return map_repo(x, oldrepo)
+
+def generate_mappings(repos, previous=None, workers=1):
+        # previous is a MappingsCache or MappingsDB of the last run, see
+        # map_repo. With more than one worker, repos are hashed by a pool of
+        # that many processes; the result is the same either way.
+        # Returns [(repo, [(branch, maps)])] in the order of repos, for
+        # mappings_xml() or write_mappings_db()
+        generate_mappings.previous = previous
+        if workers > 1:
+            # Created before this process touches the blob store or git,
+            # so the workers open their own
+            pool = multiprocessing.Pool(workers)
+            results = pool.imap(map_repo_previous, repos)
+        else:
+            pool = None
+            results = itertools.imap(map_repo_previous, repos)
+
+        mappings = []
+        try:
+            for x in repos:
+                branches, newblobs = results.next()
+                for sha, md5, size in newblobs:
+                    store_blob(sha, md5, size, commit=False)
+                flush_blobstore()
+                mappings.append((x, branches))
+        finally:
+            generate_mappings.previous = None
+            if pool is not None:
+                pool.terminate()
+        return mappings
+
+# The mappingscache.xml document for mappings as returned by
+# generate_mappings()
+def mappings_xml(mappings):
         impl = getDOMImplementation()
         indexdoc = impl.createDocument(None, "maps", None)
-        
-        for x in repos:
+
+        for x, branches in mappings:
                 pkgelement = indexdoc.createElement("repo")
                 pkgelement.setAttribute("path", x)
-                
-                repo = git.Repo(x, odbt=git.GitDB)
-                for branch in repo.heads:
-                    toprev = 0
-                    for xz in repo.iter_commits(branch):
-                      toprev = toprev + 1
-                    rev = 0
-
-                    for cm in repo.iter_commits(branch):
-                      entries = {}
-                      for entry in cm.tree:
-                         if entry.name == "_meta" or entry.name == "_attribute":
-                              continue
-                         st = git_cat(x, entry.hexsha)
-                         assert len(st) == entry.size
-                         m = hashlib.md5(st)
-                         entries[entry.name] = m.hexdigest()
-                      sortedkeys = sorted(entries.keys())
-                      meta = ""
-                      for y in sortedkeys:
-                         meta += entries[y]
-                         meta += "  "
-                         meta += y
-                         meta += "\n"
-    
-                      m = hashlib.md5(meta)
+                for branch, maps in branches:
+                    for y in maps:
                       mapelm = indexdoc.createElement("map")
-                      mapelm.setAttribute("branch", branch.name)
-                      mapelm.setAttribute("commit", cm.hexsha)
-                      mapelm.setAttribute("srcmd5", m.hexdigest())
-                      mapelm.setAttribute("rev", str(toprev-rev))
-                      for y in sortedkeys:
+                      mapelm.setAttribute("branch", branch)
+                      mapelm.setAttribute("commit", y.commit)
+                      mapelm.setAttribute("srcmd5", y.srcmd5)
+                      mapelm.setAttribute("rev", y.rev)
+                      if y.mtime is not None:
+                          mapelm.setAttribute("mtime", str(y.mtime))
+                      for entry in y.entries:
                           entryelm = indexdoc.createElement("entry")
-                          entryelm.setAttribute("name", y)
-                          entryelm.setAttribute("md5", entries[y])
+                          entryelm.setAttribute("name", entry.name)
+                          entryelm.setAttribute("md5", entry.md5)
+                          if entry.sha is not None:
+                              entryelm.setAttribute("sha", entry.sha)
+                              entryelm.setAttribute("size", str(entry.size))
                           mapelm.appendChild(entryelm)
-                      pkgelement.appendChild(mapelm)   
-                      rev = rev + 1     
+                      pkgelement.appendChild(mapelm)
                 indexdoc.childNodes[0].appendChild(pkgelement)
-                rev = rev + 1     
         return indexdoc.childNodes[0].toprettyxml()
 
+# Writes mappings as returned by generate_mappings() to a new sqlite file
+def write_mappings_db(filename, mappings):
+        if os.path.exists(filename):
+            os.unlink(filename)
+        db = sqlite3.connect(filename)
+        try:
+            db.executescript(MAPPINGSDB_SCHEMA)
+            mapid = 0
+            for repoid, (x, branches) in enumerate(mappings):
+                db.execute("INSERT INTO repos (id, path) VALUES (?, ?)", (repoid, x))
+                for branch, maps in branches:
+                    for y in maps:
+                        mapid = mapid + 1
+                        db.execute("INSERT INTO maps (id, repo, branch, commitsha, rev, srcmd5, mtime) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                   (mapid, repoid, branch, y.commit, y.rev, y.srcmd5, y.mtime))
+                        db.executemany("INSERT INTO entries (map, name, md5, sha, size) VALUES (?, ?, ?, ?, ?)",
+                                       [(mapid,) + tuple(x) for x in y.entries])
+            db.commit()
+        finally:
+            db.close()
+
+# [(repo, [(branch, maps)])] of a MappingsCache or MappingsDB, to export
+# it with mappings_xml() or write_mappings_db()
+def read_mappings(mcache):
+        mappings = []
+        for x in mcache.repo_paths():
+            mappings.append((x, mcache.get_repo(x).branches.items()))
+        return mappings
+
 #generate_mappings("Base")        
         
 # Normal package
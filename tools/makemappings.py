@@ -1,6 +1,24 @@
-import sys, gitmer
+import sys, os, optparse, gitmer
 
-f = open(sys.argv[1], "r")
+# Usage: makemappings.py repos.lst mappingscache.{db,xml} [--full] [--workers N] [--xml FILE]
+# The cache is written as sqlite if its name ends in .db, as XML otherwise.
+# Without --full the existing cache is reused and only branches that moved
+# since the last run are hashed again. --workers spreads the repos over that
+# many processes. --xml also exports the mappings as mappingscache.xml for
+# tools that still read the XML.
+
+parser = optparse.OptionParser(usage="%prog repos.lst mappingscache.{db,xml} [--full] [--workers N] [--xml FILE]")
+parser.add_option("--full", action="store_true", default=False,
+                  help="hash every branch again instead of reusing the existing cache")
+parser.add_option("--workers", type="int", default=1, metavar="N",
+                  help="number of processes hashing repos (default %default)")
+parser.add_option("--xml", metavar="FILE",
+                  help="also write the mappings as XML to FILE")
+(options, args) = parser.parse_args()
+if len(args) != 2:
+    parser.error("repos.lst and the mappings cache are required")
+
+f = open(args[0], "r")
 repos = []
 for x in f.readlines():
     x = x.strip('\r')
@@ -8,8 +26,27 @@ for x in f.readlines():
     repos.append(x)
 f.close()
 
-mappings = gitmer.generate_mappings(repos)
-f = open(sys.argv[2], "w+")
+previous = None
+if not options.full:
+    previous = gitmer.load_previous_mappings(args[1])
+    # Switching from XML to sqlite, start from the XML of the last run
+    if previous is None and options.xml:
+        previous = gitmer.load_previous_mappings(options.xml)
 
-f.write(mappings)
-f.close()
+mappings = gitmer.generate_mappings(repos, previous=previous, workers=options.workers)
+
+# Write next to the old cache and rename over it, so a running fakeobs never
+# picks up a half written file
+def write_xml(filename):
+    f = open(filename + ".new", "w+")
+    f.write(gitmer.mappings_xml(mappings))
+    f.close()
+    os.rename(filename + ".new", filename)
+
+if args[1].endswith(".db"):
+    gitmer.write_mappings_db(args[1] + ".new", mappings)
+    os.rename(args[1] + ".new", args[1])
+else:
+    write_xml(args[1])
+if options.xml:
+    write_xml(options.xml)
@@ -0,0 +1,252 @@
+import sys, os, time, optparse, threading, Queue, socket
+import httplib, urllib, urlparse, email.utils
+import xml.dom.minidom
+import cpio
+
+# Mirrors the binary repositories of an OBS project from an OBS API, or
+# another fakeobs, the way fakeobs serves them: the _repository views and
+# RPMs of each scheduler in OUTPUT/REPONAME/SCHEDULER.
+#
+# Usage: mirrorbuild.py [options] API PROJECT SCHEDULER...
+#
+# API is eg. https://api.merproject.org/public or http://localhost:8001/public
+# for a local fakeobs. OUTPUT and REPONAME come from the project's mapping in
+# mappings.xml unless given. Downloads run over a number of keep-alive
+# connections at once and cpio batches are unpacked as they arrive. RPMs
+# that are already there with the size listed in view=names are not
+# downloaded again, so an interrupted mirror continues where it stopped.
+
+VIEWS = ["cache", "names", "binaryversions", "solvstate"]
+
+# RPMs asked for in one view=cpio request
+BATCHSIZE = 48
+
+# Times a request turned away with a 503 is tried again
+RETRIES = 10
+
+class HTTPError(Exception):
+    pass
+
+outputLock = threading.Lock()
+
+# Prints a line without other threads' output getting mixed into it
+def log(message):
+    outputLock.acquire()
+    try:
+        sys.stdout.write(message + "\n")
+        sys.stdout.flush()
+    finally:
+        outputLock.release()
+
+# One keep-alive connection to the API, used by one thread at a time
+class Fetcher(object):
+    def __init__(self, api):
+        url = urlparse.urlsplit(api)
+        if url.scheme == "https":
+            self.connectionclass = httplib.HTTPSConnection
+        else:
+            self.connectionclass = httplib.HTTPConnection
+        self.netloc = url.netloc
+        self.connection = None
+
+    # Returns the response to a GET of path, once its headers are in. The
+    # caller must read the whole body before the next request.
+    def get(self, path, headers={}):
+        retries = 0
+        while True:
+            reused = self.connection is not None
+            if self.connection is None:
+                self.connection = self.connectionclass(self.netloc, timeout=300)
+            try:
+                self.connection.request("GET", path, headers=headers)
+                response = self.connection.getresponse()
+            except (httplib.HTTPException, socket.error), e:
+                self.close()
+                # The server may have closed an idle connection meanwhile
+                if reused:
+                    continue
+                raise HTTPError("%s: %s" % (path, e))
+            if response.status == 503 and retries < RETRIES:
+                response.read()
+                retries = retries + 1
+                wait = int(response.getheader("Retry-After", "5"))
+                log("%s: server busy, trying again in %d seconds" % (path.split("?")[0], wait))
+                time.sleep(wait)
+                continue
+            return response
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+# Runs jobs from a queue in a number of threads with a Fetcher each. Jobs
+# are called with the Fetcher and may add more jobs.
+class Mirror(object):
+    def __init__(self, api, connections):
+        self.api = api
+        self.connections = connections
+        self.jobs = Queue.Queue()
+        self.errors = []
+
+    def add(self, job, *args):
+        self.jobs.put((job, args))
+
+    def error(self, message):
+        log("ERROR: " + message)
+        self.errors.append(message)
+
+    def work(self):
+        fetcher = Fetcher(self.api)
+        while True:
+            job, args = self.jobs.get()
+            if job is None:
+                fetcher.close()
+                return
+            try:
+                job(fetcher, *args)
+            except Exception, e:
+                fetcher.close()
+                self.error(str(e))
+            finally:
+                self.jobs.task_done()
+
+    def run(self):
+        threads = []
+        for x in range(self.connections):
+            thread = threading.Thread(target=self.work, name="Connection %d" % x)
+            thread.start()
+            threads.append(thread)
+        self.jobs.join()
+        for thread in threads:
+            self.add(None)
+        for thread in threads:
+            thread.join()
+        return not self.errors
+
+# A scheduler of the project being mirrored into directory
+class Repository(object):
+    def __init__(self, mirror, project, reponame, scheduler, directory):
+        self.mirror = mirror
+        self.path = urlparse.urlsplit(mirror.api).path.rstrip("/") + "/build/" + \
+            "/".join([urllib.quote(x, safe=":") for x in (project, reponame, scheduler)])
+        self.directory = directory
+
+    def start(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        for view in VIEWS:
+            self.mirror.add(self.fetch_view, view)
+
+    # Saves _repository?view=view like `wget -N` does: only if it changed
+    # since the copy we have, keeping the server's modification time
+    def fetch_view(self, fetcher, view):
+        filename = os.path.join(self.directory, "_repository?view=" + view)
+        headers = {}
+        if os.path.isfile(filename):
+            headers["If-Modified-Since"] = email.utils.formatdate(os.stat(filename).st_mtime, usegmt=True)
+        response = fetcher.get(self.path + "/_repository?view=" + view, headers)
+        if response.status == 304:
+            response.read()
+        elif response.status != 200:
+            response.read()
+            raise HTTPError("%s/_repository?view=%s: %d %s" % (self.path, view, response.status, response.reason))
+        else:
+            f = open(filename + ".part", "wb")
+            try:
+                while True:
+                    data = response.read(64 * 1024)
+                    if not data:
+                        break
+                    f.write(data)
+            finally:
+                f.close()
+            lastmodified = response.getheader("Last-Modified")
+            if lastmodified is not None:
+                mtime = email.utils.mktime_tz(email.utils.parsedate_tz(lastmodified))
+                os.utime(filename + ".part", (mtime, mtime))
+            os.rename(filename + ".part", filename)
+            log("%s: %s" % (self.path, os.path.basename(filename)))
+        if view == "names":
+            self.fetch_binaries(filename)
+
+    # Queues the RPMs listed in view=names that are missing here, in
+    # batches of BATCHSIZE
+    def fetch_binaries(self, namesfile):
+        doc = xml.dom.minidom.parse(namesfile)
+        wanted = []
+        for x in doc.getElementsByTagName("binary"):
+            filename = x.attributes["filename"].value
+            if filename.endswith("debuginfo.rpm") or filename.endswith("debugsource.rpm"):
+                continue
+            size = int(x.attributes["size"].value)
+            path = os.path.join(self.directory, filename)
+            if os.path.isfile(path) and os.path.getsize(path) == size:
+                continue
+            wanted.append((filename, size))
+        log("%s: %d binaries to fetch" % (self.path, len(wanted)))
+        for x in range(0, len(wanted), BATCHSIZE):
+            self.mirror.add(self.fetch_batch, wanted[x:x + BATCHSIZE])
+
+    def fetch_batch(self, fetcher, binaries):
+        query = [("view", "cpio")] + [("binary", os.path.splitext(x[0])[0]) for x in binaries]
+        response = fetcher.get(self.path + "/_repository?" + urllib.urlencode(query))
+        if response.status != 200:
+            response.read()
+            raise HTTPError("%s: view=cpio: %d %s" % (self.path, response.status, response.reason))
+        try:
+            cpio.extract(response, self.directory)
+        except:
+            fetcher.close()
+            raise
+        # Block padding after the trailer
+        response.read()
+        for filename, size in binaries:
+            path = os.path.join(self.directory, filename)
+            if not os.path.isfile(path):
+                self.mirror.error("%s: %s is missing from view=cpio" % (self.path, filename))
+            elif os.path.getsize(path) != size:
+                self.mirror.error("%s: %s is %d bytes, expected %d" % (self.path, filename, os.path.getsize(path), size))
+            else:
+                log("%s: %s" % (self.path, filename))
+
+def find_mapping(mappingsfile, project):
+    doc = xml.dom.minidom.parse(mappingsfile)
+    for x in doc.getElementsByTagName("mapping"):
+        if x.attributes["project"].value == project:
+            return x
+    return None
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="%prog [options] API PROJECT SCHEDULER...")
+    parser.add_option("--mappings", default="mappings.xml", metavar="FILE",
+                      help="where to look up the project (default %default)")
+    parser.add_option("--output", metavar="DIR",
+                      help="mirror into DIR instead of the project's binaries directory")
+    parser.add_option("--reponame", metavar="NAME",
+                      help="repository to mirror instead of the project's reponame")
+    parser.add_option("--connections", type="int", default=4, metavar="N",
+                      help="number of concurrent connections (default %default)")
+    (options, args) = parser.parse_args()
+    if len(args) < 3:
+        parser.error("API, PROJECT and at least one SCHEDULER are required")
+    api, project, schedulers = args[0], args[1], args[2:]
+
+    output, reponame = options.output, options.reponame
+    if output is None or reponame is None:
+        mapping = find_mapping(options.mappings, project)
+        if mapping is None:
+            parser.error("%s is not in %s, give --output and --reponame" % (project, options.mappings))
+        if output is None and mapping.hasAttribute("binaries"):
+            output = mapping.attributes["binaries"].value
+        if reponame is None and mapping.hasAttribute("reponame"):
+            reponame = mapping.attributes["reponame"].value
+        if output is None or reponame is None:
+            parser.error("%s has no binaries or reponame in %s" % (project, options.mappings))
+
+    mirror = Mirror(api, options.connections)
+    for scheduler in schedulers:
+        Repository(mirror, project, reponame, scheduler, os.path.join(output, reponame, scheduler)).start()
+    if not mirror.run():
+        log("%d errors mirroring %s" % (len(mirror.errors), project))
+        sys.exit(1)
@@ -1,10 +1,28 @@
 import gitmer
-import sys
+import sys, os
 import xml.dom.minidom
 import time
 
 if len(sys.argv) > 2:
-  gitmer.update_package_xml(sys.argv[1], package=sys.argv[2])
+  changed = gitmer.update_package_xml(sys.argv[1], package=sys.argv[2])
 else:
-  gitmer.update_package_xml(sys.argv[1])
-            
+  changed = gitmer.update_package_xml(sys.argv[1])
+
+# Tell the OBS instances following us about the changed packages, and
+# about links to them, in one go
+projectpath = os.path.dirname(sys.argv[1]) or "."
+links = gitmer.get_project(projectpath).links
+names = list(changed)
+for x in sorted(links.keys()):
+  if links[x] in changed:
+    names.append(x)
+
+events = []
+doc = xml.dom.minidom.parse("mappings.xml")
+for x in doc.getElementsByTagName("mapping"):
+  if os.path.normpath(x.attributes["path"].value) != os.path.normpath(projectpath):
+    continue
+  for name in names:
+    events.append(("package", x.attributes["project"].value, name, ""))
+if events:
+  gitmer.append_events(events)
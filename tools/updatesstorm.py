@@ -5,12 +5,9 @@ import time
 
 doc = xml.dom.minidom.parse("mappings.xml")            
 
+events = []
 def newevent(type, project, package, x1):
-    newevent= "" + str(gitmer.get_next_event() + 1) + "|" + str(int(time.time())) + "|" + type + "|" + project + "|" + package + "|" + x1 + "\n"
-
-    f = open("lastevents", "a")
-    f.write(newevent)
-    f.close()
+    events.append((type, project, package, x1))
 
 for x in doc.getElementsByTagName("mapping"):
      packagesdoc = xml.dom.minidom.parse(x.attributes["path"].value + "/packages.xml")            
@@ -23,3 +20,5 @@ for x in doc.getElementsByTagName("mapping"):
       newevent("repository", x.attributes["project"].value, x.attributes["reponame"].value, "i586")
       newevent("repository", x.attributes["project"].value, x.attributes["reponame"].value, "armv7el")
       newevent("repository", x.attributes["project"].value, x.attributes["reponame"].value, "armv8el")
+
+gitmer.append_events(events)